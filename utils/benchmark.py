@@ -0,0 +1,265 @@
+"""
+Inference benchmark suite for the prediction helpers
+
+Measures ``predict_with_model`` / ``batch_predict`` across batch sizes,
+sequence lengths, thread counts and precisions on CPU, and writes the
+results as JSON so runs can be compared over time.
+
+Usage:
+    python -m utils.benchmark --model distilbert-base-uncased-finetuned-sst-2-english \
+        --batch-sizes 1 8 32 --seq-lengths 32 128 --threads 1 4 --output bench.json
+
+    # Cold-start cost of importing the helpers in a fresh interpreter
+    python -m utils.benchmark --import-time
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from utils.helpers import batch_predict, predict_with_model
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+HEAVY_MODULES = ('torch', 'transformers', 'matplotlib', 'seaborn', 'sklearn', 'pandas', 'scipy')
+
+_IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss = rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+except ImportError:
+    rss = None
+print(json.dumps({{'seconds': elapsed, 'rss_mb': rss,
+                  'modules': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+DEFAULT_TEXTS = [
+    "This product is amazing! I love it.",
+    "Terrible experience, would not recommend.",
+    "It's okay, nothing special.",
+    "Best purchase I've made this year!",
+]
+
+
+def peak_rss_mb() -> float:
+    """Return the process's peak resident set size so far in MB (None if unknown)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def make_texts(tokenizer, seq_len: int, count: int, texts: List[str] = None) -> List[str]:
+    """Build ``count`` texts that tokenize to roughly ``seq_len`` tokens each."""
+    texts = texts or DEFAULT_TEXTS
+    result = []
+    for i in range(count):
+        base = texts[i % len(texts)]
+        ids = tokenizer(base, add_special_tokens=False)['input_ids']
+        repeats = seq_len // max(len(ids), 1) + 1
+        ids = (ids * repeats)[:max(seq_len - 2, 1)]  # leave room for [CLS]/[SEP]
+        result.append(tokenizer.decode(ids))
+    return result
+
+
+def with_precision(model, precision: str):
+    """Return a copy of ``model`` in the given precision ('fp32', 'bf16' or 'int8')."""
+    if precision == 'fp32':
+        return model
+    if precision == 'bf16':
+        return copy.deepcopy(model).to(torch.bfloat16)
+    if precision == 'int8':
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f"Unknown precision: {precision} (expected fp32, bf16 or int8)")
+
+
+def _time_config(model, tokenizer, texts: List[str], batch_size: int,
+                 num_runs: int, warmup: int) -> List[float]:
+    """Return per-call latencies in ms for one configuration."""
+    if batch_size == 1:
+        def call(i):
+            predict_with_model(texts[i % len(texts)], model, tokenizer)
+    else:
+        def call(i):
+            batch_predict(texts, model, tokenizer, batch_size=batch_size)
+
+    for i in range(warmup):
+        call(i)
+
+    latencies = []
+    for i in range(num_runs):
+        start = time.perf_counter()
+        call(i)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def run_benchmark(model, tokenizer, batch_sizes: List[int] = (1, 8, 32),
+                  seq_lengths: List[int] = (32, 128), thread_counts: List[int] = None,
+                  precisions: List[str] = ('fp32',), num_runs: int = 20, warmup: int = 3,
+                  texts: List[str] = None, output_path: str = None) -> Dict:
+    """Benchmark inference over every combination of the given settings.
+
+    Batch size 1 times ``predict_with_model``; larger batch sizes time one
+    ``batch_predict`` call over ``batch_size`` texts. Each result row has
+    p50/p95/p99/mean latency in ms, throughput in examples/sec and the
+    process's peak RSS so far (a high-water mark, so it only grows).
+    Returns a dict with ``environment`` and ``results`` and, if
+    ``output_path`` is given, also writes it there as JSON.
+    """
+    thread_counts = thread_counts or [torch.get_num_threads()]
+    original_threads = torch.get_num_threads()
+    model.eval()
+
+    results = []
+    try:
+        for precision in precisions:
+            bench_model = with_precision(model, precision)
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                for seq_len in seq_lengths:
+                    for batch_size in batch_sizes:
+                        config_texts = make_texts(tokenizer, seq_len, batch_size, texts)
+                        latencies = np.array(_time_config(bench_model, tokenizer, config_texts,
+                                                          batch_size, num_runs, warmup))
+                        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                        results.append({
+                            'precision': precision,
+                            'threads': threads,
+                            'seq_len': seq_len,
+                            'batch_size': batch_size,
+                            'p50_ms': float(p50),
+                            'p95_ms': float(p95),
+                            'p99_ms': float(p99),
+                            'mean_ms': float(latencies.mean()),
+                            'throughput': float(batch_size * 1000 / latencies.mean()),
+                            'peak_rss_mb': peak_rss_mb(),
+                        })
+    finally:
+        torch.set_num_threads(original_threads)
+
+    report = {
+        'environment': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'model': model.__class__.__name__,
+            'model_name': getattr(getattr(model, 'config', None), '_name_or_path', ''),
+            'torch_version': torch.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'num_runs': num_runs,
+        },
+        'results': results,
+    }
+
+    if output_path is not None:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    return report
+
+
+def measure_import_time(module: str = 'utils.helpers', runs: int = 5) -> Dict:
+    """Time a cold import of ``module`` in ``runs`` fresh interpreters.
+
+    Returns the median/min import time in seconds, the peak RSS after the
+    import, and which heavy libraries (torch, matplotlib, ...) the import
+    pulled in.
+    """
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = _IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)
+
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=repo_root,
+                                capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    seconds = [sample['seconds'] for sample in samples]
+    return {
+        'module': module,
+        'runs': runs,
+        'median_seconds': float(np.median(seconds)),
+        'min_seconds': float(min(seconds)),
+        'rss_mb': samples[-1]['rss_mb'],
+        'heavy_modules_loaded': samples[-1]['modules'],
+    }
+
+
+def print_benchmark_results(report: Dict):
+    """Print benchmark results as a table."""
+    print("=" * 86)
+    print("INFERENCE BENCHMARK")
+    print("=" * 86)
+    print(f"{'precision':>9} {'threads':>7} {'seq_len':>7} {'batch':>5} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ex/sec':>9} {'RSS MB':>9}")
+    for row in report['results']:
+        rss = f"{row['peak_rss_mb']:.0f}" if row['peak_rss_mb'] is not None else 'n/a'
+        print(f"{row['precision']:>9} {row['threads']:>7} {row['seq_len']:>7} "
+              f"{row['batch_size']:>5} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+              f"{row['p99_ms']:>9.2f} {row['throughput']:>9.1f} {rss:>9}")
+    print("=" * 86)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark CPU inference of a classification model")
+    parser.add_argument('--model', help="Model name or path")
+    parser.add_argument('--import-time', action='store_true',
+                        help="Only measure the cold import time of utils.helpers")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--seq-lengths', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--threads', type=int, nargs='+', default=None)
+    parser.add_argument('--precisions', nargs='+', default=['fp32'],
+                        choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--num-runs', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--output', default=None, help="Write JSON results to this path")
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        report = measure_import_time()
+        print(f"import {report['module']}: median {report['median_seconds'] * 1000:.0f} ms, "
+              f"min {report['min_seconds'] * 1000:.0f} ms, RSS {report['rss_mb']:.0f} MB")
+        print(f"Heavy modules loaded: {', '.join(report['heavy_modules_loaded']) or 'none'}")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        return
+    if not args.model:
+        parser.error("--model is required unless --import-time is given")
+
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model)
+    model = AutoModelForSequenceClassification.from_pretrained(args.model)
+
+    report = run_benchmark(model, tokenizer, batch_sizes=args.batch_sizes,
+                           seq_lengths=args.seq_lengths, thread_counts=args.threads,
+                           precisions=args.precisions, num_runs=args.num_runs,
+                           warmup=args.warmup, output_path=args.output)
+    print_benchmark_results(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,196 +2,2168 @@
 Helper utilities for fine-tuning lessons
 """
 
+import csv
+import hashlib
+import inspect
+import json
+import multiprocessing as mp
+import os
+import platform
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import islice
+from types import SimpleNamespace
+
 import torch
 import numpy as np
-from typing import Dict, List, Tuple
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.metrics import confusion_matrix, classification_report
-
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+# matplotlib and seaborn are imported inside the plotting functions so that
+# inference-only workers don't pay for them at import time.
+
+
+def _tensor_key(tensor: torch.Tensor):
+    """Identity of the memory behind ``tensor``, so tied weights count once."""
+    if tensor.device.type == 'meta':
+        return id(tensor)
+    return (tensor.device.type, tensor.untyped_storage().data_ptr(), tensor.storage_offset(),
+            tuple(tensor.shape), tensor.dtype)
+
+
+def _module_tensors(module: torch.nn.Module) -> Iterator[Tuple[str, torch.Tensor]]:
+    """Yield ``(kind, tensor)`` for the tensors a module owns directly.
+
+    Dynamically quantized layers keep their int8 weights in packed params
+    rather than ``parameters()``, so those are unpacked and reported too.
+    """
+    for param in module._parameters.values():
+        if param is not None:
+            yield 'param', param
+    for buffer in module._buffers.values():
+        if buffer is not None:
+            yield 'buffer', buffer
+    # Unpack at the quantized layer itself, not its LinearPackedParams child
+    if isinstance(getattr(module, '_packed_params', None), torch.nn.Module):
+        for tensor in module._weight_bias():
+            if tensor is not None:
+                yield 'packed', tensor
+
+
+def _first_config_value(config, names: Tuple[str, ...]):
+    for name in names:
+        value = getattr(config, name, None)
+        if value is not None:
+            return value
+    return None
+
+
+def estimate_activation_bytes(model, batch_size: int = 1, seq_len: int = 128,
+                              dtype: torch.dtype = None) -> int:
+    """Estimate peak activation memory for one inference forward pass.
+
+    Uses the transformer shape in ``model.config``. Under no-grad only one
+    layer's intermediates are alive at a time, so the peak is one layer's
+    working set: the hidden states, Q/K/V, attention context and output
+    (``5 * hidden``), the feed-forward intermediate, and the attention
+    scores and probabilities (``2 * heads * seq_len``) per token. Returns
+    None when the config doesn't describe a transformer encoder.
+    """
+    config = getattr(model, 'config', None)
+    hidden = _first_config_value(config, ('hidden_size', 'dim', 'd_model'))
+    heads = _first_config_value(config, ('num_attention_heads', 'n_heads', 'n_head'))
+    if hidden is None or heads is None:
+        return None
+    intermediate = (_first_config_value(config, ('intermediate_size', 'ffn_dim', 'd_ff'))
+                    or (config.hidden_dim if hasattr(config, 'dim') and hasattr(config, 'hidden_dim')
+                        else 4 * hidden))
+    if dtype is None:
+        dtype = next((p.dtype for p in model.parameters() if p.is_floating_point()), torch.float32)
+    element_size = torch.empty((), dtype=dtype).element_size()
+
+    tokens = batch_size * seq_len
+    per_layer = tokens * (5 * hidden + intermediate) + 2 * batch_size * heads * seq_len * seq_len
+    inputs = 2 * tokens * torch.empty((), dtype=torch.int64).element_size()  # ids + mask
+    return int(per_layer * element_size + inputs)
+
+
+def inspect_model(model: torch.nn.Module, batch_size: int = 1, seq_len: int = 128,
+                  depth: int = 2) -> Dict:
+    """Account for a model's memory in one pass over its modules.
+
+    Parameters and buffers are counted at their real element size, tied or
+    shared tensors are counted once, and totals are broken down by dtype and
+    by submodule (module names truncated to ``depth`` components; tensors
+    belong to the first module that owns them). ``activation_bytes`` is the
+    ``estimate_activation_bytes`` estimate for ``batch_size`` x ``seq_len``.
+    """
+    seen = set()
+    alive = []  # unpacked quantized weights are temporaries; hold them so addresses aren't reused
+    report = {
+        'model_type': model.__class__.__name__,
+        'total_params': 0,
+        'trainable_params': 0,
+        'param_bytes': 0,
+        'buffer_bytes': 0,
+        'shared_tensors': 0,
+        'shared_bytes': 0,
+        'bytes_by_dtype': {},
+        'modules': {},
+    }
 
-def print_model_info(model):
-    """Print detailed information about a model."""
-    total_params = sum(p.numel() for p in model.parameters())
-    trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+    for name, module in model.named_modules():
+        if hasattr(module, '_packed_params') and not isinstance(module._packed_params, torch.nn.Module):
+            continue
+        group = '.'.join(name.split('.')[:depth]) or '(root)'
+        for kind, tensor in _module_tensors(module):
+            nbytes = tensor.numel() * tensor.element_size()
+            key = _tensor_key(tensor)
+            if key in seen:
+                report['shared_tensors'] += 1
+                report['shared_bytes'] += nbytes
+                continue
+            seen.add(key)
+            if kind == 'packed':
+                alive.append(tensor)
+
+            entry = report['modules'].setdefault(
+                group, {'params': 0, 'param_bytes': 0, 'buffer_bytes': 0})
+            dtype = str(tensor.dtype).replace('torch.', '')
+            report['bytes_by_dtype'][dtype] = report['bytes_by_dtype'].get(dtype, 0) + nbytes
+            if kind == 'buffer':
+                report['buffer_bytes'] += nbytes
+                entry['buffer_bytes'] += nbytes
+            else:
+                report['total_params'] += tensor.numel()
+                report['param_bytes'] += nbytes
+                entry['params'] += tensor.numel()
+                entry['param_bytes'] += nbytes
+                if tensor.requires_grad:
+                    report['trainable_params'] += tensor.numel()
+
+    report['non_trainable_params'] = report['total_params'] - report['trainable_params']
+    report['total_bytes'] = report['param_bytes'] + report['buffer_bytes']
+    report['batch_size'] = batch_size
+    report['seq_len'] = seq_len
+    report['activation_bytes'] = estimate_activation_bytes(model, batch_size, seq_len)
+    report['estimated_peak_bytes'] = report['total_bytes'] + (report['activation_bytes'] or 0)
+    return report
+
+
+def print_model_info(model, batch_size: int = 1, seq_len: int = 128, depth: int = 2) -> Dict:
+    """Print detailed information about a model and return the ``inspect_model`` report."""
+    report = inspect_model(model, batch_size=batch_size, seq_len=seq_len, depth=depth)
+    mb = 1024 * 1024
 
     print("=" * 60)
     print("MODEL INFORMATION")
     print("=" * 60)
-    print(f"Model type: {model.__class__.__name__}")
-    print(f"Total parameters: {total_params:,}")
-    print(f"Trainable parameters: {trainable_params:,}")
-    print(f"Non-trainable parameters: {total_params - trainable_params:,}")
-    print(f"Model size (MB): {total_params * 4 / 1024 / 1024:.2f}")
+    print(f"Model type: {report['model_type']}")
+    print(f"Total parameters: {report['total_params']:,}")
+    print(f"Trainable parameters: {report['trainable_params']:,}")
+    print(f"Non-trainable parameters: {report['non_trainable_params']:,}")
+    print(f"Model size (MB): {report['total_bytes'] / mb:.2f} "
+          f"(parameters {report['param_bytes'] / mb:.2f}, buffers {report['buffer_bytes'] / mb:.2f})")
+    print("By dtype: " + ", ".join(f"{dtype} {nbytes / mb:.2f} MB"
+                                   for dtype, nbytes in report['bytes_by_dtype'].items()))
+    if report['shared_tensors']:
+        print(f"Shared tensors: {report['shared_tensors']} "
+              f"({report['shared_bytes'] / mb:.2f} MB counted once)")
+
+    print("\nBy submodule:")
+    for name, entry in report['modules'].items():
+        print(f"  {name:<40} {entry['params']:>12,} params "
+              f"{(entry['param_bytes'] + entry['buffer_bytes']) / mb:>9.2f} MB")
+
+    if report['activation_bytes'] is not None:
+        print(f"\nActivations (batch {batch_size} x {seq_len} tokens): "
+              f"~{report['activation_bytes'] / mb:.2f} MB")
+        print(f"Estimated peak inference memory: ~{report['estimated_peak_bytes'] / mb:.2f} MB")
     print("=" * 60)
+    return report
+
+
+def _print_length_distribution(name: str, lengths: np.ndarray):
+    p50, p95, p99 = np.percentile(lengths, [50, 95, 99])
+    print(f"  {name}: min {lengths.min()} | mean {lengths.mean():.1f} | "
+          f"p50 {p50:.0f} | p95 {p95:.0f} | p99 {p99:.0f} | max {lengths.max()}")
+
 
+def print_dataset_info(dataset, sample_size: int = None, text_column: str = 'text',
+                       tokenizer=None, seed: int = 42):
+    """Print information about a dataset.
 
-def print_dataset_info(dataset):
-    """Print information about a dataset."""
+    Only the label and text columns are read, straight from Arrow. Pass
+    ``sample_size`` to compute the statistics on a random subset of very
+    large datasets, and a ``tokenizer`` to also report token lengths.
+    """
     print("=" * 60)
     print("DATASET INFORMATION")
     print("=" * 60)
     print(f"Number of examples: {len(dataset)}")
     print(f"Features: {list(dataset.features.keys())}")
 
+    if sample_size is not None and sample_size < len(dataset):
+        rng = np.random.default_rng(seed)
+        indices = np.sort(rng.choice(len(dataset), size=sample_size, replace=False))
+        dataset = dataset.select(indices)
+        print(f"(Statistics below are from a random sample of {sample_size:,} examples)")
+
+    arrow_dataset = dataset.with_format('arrow')
+
     # Check for label distribution if labels exist
     if 'label' in dataset.features:
-        labels = [example['label'] for example in dataset]
-        unique_labels = set(labels)
+        labels = np.asarray(arrow_dataset['label'].to_numpy())
+        if labels.size and np.issubdtype(labels.dtype, np.integer) and labels.min() >= 0:
+            counts = np.bincount(labels)
+            unique_labels = np.flatnonzero(counts)
+            counts = counts[unique_labels]
+        else:
+            unique_labels, counts = np.unique(labels, return_counts=True)
         print(f"\nLabel distribution:")
-        for label in sorted(unique_labels):
-            count = labels.count(label)
+        for label, count in zip(unique_labels, counts):
             pct = (count / len(labels)) * 100
             print(f"  Label {label}: {count} ({pct:.1f}%)")
 
+    if text_column in dataset.features and len(dataset):
+        import pyarrow.compute as pc
+
+        texts = arrow_dataset[text_column]
+        print(f"\nLength distribution ({text_column}):")
+        _print_length_distribution("Characters", np.asarray(pc.utf8_length(texts).to_numpy()))
+        if tokenizer is not None:
+            token_lengths = np.concatenate([
+                [len(ids) for ids in tokenizer(batch[text_column], truncation=False)['input_ids']]
+                for batch in dataset.select_columns([text_column]).iter(batch_size=1000)
+            ])
+            _print_length_distribution("Tokens", token_lengths)
+
     print("=" * 60)
 
 
-def plot_training_history(training_logs: List[Dict]):
-    """Plot training and validation metrics over time."""
-    fig, axes = plt.subplots(1, 2, figsize=(15, 5))
+def _new_figure(headless: bool, **kwargs):
+    """Create a figure: standalone (never registered with pyplot) when headless."""
+    if headless:
+        from matplotlib.figure import Figure
+        return Figure(**kwargs)
+    import matplotlib.pyplot as plt
+    return plt.figure(**kwargs)
+
+
+def _finish_figure(fig, save_path, format: str = None):
+    """Show the figure, or render it to ``save_path`` (a path or binary file object)."""
+    if save_path is None:
+        import matplotlib.pyplot as plt
+        plt.show()
+        return
+    # Standalone figures render through the Agg/SVG canvases without a GUI
+    # backend and are freed once unreferenced, so nothing leaks across runs.
+    fig.savefig(save_path, format=format, bbox_inches='tight')
+
+
+def _lttb_indices(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """Largest-Triangle-Three-Buckets: pick the points that best preserve the shape."""
+    n = len(y)
+    every = (n - 2) / (max_points - 2)
+    selected = [0]
+    anchor = 0
+    for i in range(max_points - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        if end >= next_end:
+            avg_x, avg_y = x[n - 1], y[n - 1]
+        else:
+            avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[anchor] - avg_x) * (y[start:end] - y[anchor])
+                      - (x[anchor] - x[start:end]) * (avg_y - y[anchor]))
+        anchor = start + int(np.argmax(area))
+        selected.append(anchor)
+    selected.append(n - 1)
+    return np.asarray(selected)
+
+
+def downsample_series(x: np.ndarray, y: np.ndarray, max_points: int,
+                      method: str = 'minmax') -> Tuple[np.ndarray, np.ndarray]:
+    """Reduce a series to about ``max_points`` points for plotting.
+
+    ``'minmax'`` keeps each bucket's min and max, so spikes survive;
+    ``'lttb'`` (Largest-Triangle-Three-Buckets) keeps the visual shape.
+    ``max_points`` is raised to the method's minimum (2 for ``'minmax'``,
+    3 for ``'lttb'``).
+    """
+    if max_points is None:
+        return x, y
+    max_points = max(max_points, 3 if method == 'lttb' else 2)
+    if len(y) <= max_points:
+        return x, y
+    if method == 'lttb':
+        keep = _lttb_indices(np.asarray(x, dtype=np.float64), y, max_points)
+    elif method == 'minmax':
+        edges = np.linspace(0, len(y), max_points // 2 + 1).astype(int)
+        keep = []
+        for start, end in zip(edges[:-1], edges[1:]):
+            if end > start:
+                bucket = y[start:end]
+                keep.extend(sorted({start + int(np.argmin(bucket)),
+                                    start + int(np.argmax(bucket))}))
+        keep = np.asarray(keep, dtype=np.intp)
+    else:
+        raise ValueError(f"Unknown downsampling method: {method} (expected minmax or lttb)")
+    return x[keep], y[keep]
+
+
+def _first_json_byte(f) -> bytes:
+    """First non-whitespace byte of a binary file, leaving the file at its start."""
+    first = b''
+    while not first:
+        chunk = f.read(4096)
+        if not chunk:
+            break
+        first = chunk.lstrip()[:1]
+    f.seek(0)
+    return first
+
+
+def _iter_log_records(source) -> Iterator[Dict]:
+    """Yield log records from a list of dicts, a JSONL file or a trainer_state.json.
+
+    A ``.json`` file may hold either a trainer state (a dict with
+    ``log_history``) or a bare ``log_history`` list. A file that yields no
+    records raises ``ValueError``.
+    """
+    if not isinstance(source, str):
+        yield from source
+        return
+
+    count = 0
+    if source.endswith('.jsonl'):
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    count += 1
+                    yield json.loads(line)
+    else:
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+        with open(source, 'rb') as f:
+            if ijson is not None:
+                # Stream the records without loading the whole file
+                prefix = 'item' if _first_json_byte(f) == b'[' else 'log_history.item'
+                records = ijson.items(f, prefix, use_float=True)
+            else:
+                state = json.load(f)
+                records = state.get('log_history', []) if isinstance(state, dict) else state
+            for record in records:
+                count += 1
+                yield record
+
+    if count == 0:
+        raise ValueError(f"No log records found in {source}")
+
+
+def load_training_history(source, metrics: List[str] = None, max_points: int = None,
+                          method: str = 'minmax') -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Load training logs in one pass into ``{metric: (steps, values)}`` arrays.
+
+    ``source`` is a Trainer ``log_history`` list, a JSONL log (one record
+    per line) or a ``trainer_state.json`` (streamed with ``ijson`` when it
+    is installed). Each metric is paired with the ``step`` it was logged
+    at (the record's position if there is no ``step``), so training and
+    eval curves line up. By default every numeric key except ``step`` is
+    collected; pass ``metrics`` to keep only some. ``max_points``
+    downsamples each series with ``downsample_series``.
+    """
+    wanted = set(metrics) if metrics is not None else None
+    steps, values = {}, {}
+
+    for position, record in enumerate(_iter_log_records(source)):
+        step = record.get('step', position)
+        for key, value in record.items():
+            if key == 'step' or (wanted is not None and key not in wanted):
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if key not in values:
+                steps[key], values[key] = array('q'), array('d')
+            steps[key].append(int(step))
+            values[key].append(float(value))
+
+    history = {}
+    for key in values:
+        x = np.frombuffer(steps[key], dtype=np.int64)
+        y = np.frombuffer(values[key], dtype=np.float64)
+        history[key] = downsample_series(x, y, max_points, method)
+    return history
+
+
+def plot_training_history(training_logs, save_path=None, format: str = None,
+                          max_points: int = 2000, method: str = 'minmax'):
+    """Plot training and validation metrics over time.
+
+    ``training_logs`` can be a Trainer ``log_history`` list, a path to a
+    JSONL log or ``trainer_state.json``, or the output of
+    ``load_training_history``; curves are plotted against the training
+    step. By default the plot is shown with ``plt.show()``. Pass
+    ``save_path`` (a file path, or a binary file object such as
+    ``io.BytesIO`` to get the image bytes) to render headlessly instead;
+    ``format`` ('png', 'svg', ...) defaults to the file extension. Series
+    longer than ``max_points`` are downsampled with ``method``
+    ('minmax' or 'lttb').
+    """
+    if isinstance(training_logs, dict):
+        history = training_logs
+    else:
+        history = load_training_history(training_logs,
+                                        metrics=['loss', 'eval_loss', 'eval_accuracy'])
+
+    fig = _new_figure(headless=save_path is not None, figsize=(15, 5))
+    axes = fig.subplots(1, 2)
 
-    # Extract metrics
-    train_loss = [log['loss'] for log in training_logs if 'loss' in log]
-    eval_loss = [log['eval_loss'] for log in training_logs if 'eval_loss' in log]
+    def plot_series(ax, metric, **kwargs):
+        x, y = downsample_series(*history[metric], max_points, method)
+        if len(y) > 200:
+            kwargs.pop('marker', None)  # markers are slow and unreadable on long runs
+        ax.plot(x, y, **kwargs)
 
     # Plot loss
-    axes[0].plot(train_loss, label='Training Loss', marker='o')
-    if eval_loss:
-        axes[0].plot(eval_loss, label='Validation Loss', marker='s')
-    axes[0].set_xlabel('Epoch')
+    if 'loss' in history:
+        plot_series(axes[0], 'loss', label='Training Loss', marker='o')
+    if 'eval_loss' in history:
+        plot_series(axes[0], 'eval_loss', label='Validation Loss', marker='s')
+    axes[0].set_xlabel('Step')
     axes[0].set_ylabel('Loss')
     axes[0].set_title('Training and Validation Loss')
     axes[0].legend()
     axes[0].grid(True, alpha=0.3)
 
     # Plot accuracy if available
-    if any('eval_accuracy' in log for log in training_logs):
-        eval_accuracy = [log['eval_accuracy'] for log in training_logs if 'eval_accuracy' in log]
-        axes[1].plot(eval_accuracy, label='Validation Accuracy', marker='s', color='green')
-        axes[1].set_xlabel('Epoch')
+    if 'eval_accuracy' in history:
+        plot_series(axes[1], 'eval_accuracy', label='Validation Accuracy', marker='s',
+                    color='green')
+        axes[1].set_xlabel('Step')
         axes[1].set_ylabel('Accuracy')
         axes[1].set_title('Validation Accuracy')
         axes[1].legend()
         axes[1].grid(True, alpha=0.3)
 
-    plt.tight_layout()
-    plt.show()
+    fig.tight_layout()
+    _finish_figure(fig, save_path, format)
+
+
+def compute_confusion_matrix(y_true, y_pred, num_classes: int = None) -> np.ndarray:
+    """Compute a confusion matrix (rows: true, columns: predicted) in one pass.
+
+    Labels must be integers in ``[0, num_classes)``; by default
+    ``num_classes`` is one more than the largest label seen. Out-of-range
+    labels (including ignore values such as ``-100``) raise ``ValueError``.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    if y_true.shape != y_pred.shape:
+        raise ValueError(f"y_true and y_pred have different shapes: {y_true.shape} vs {y_pred.shape}")
+    if num_classes is None:
+        num_classes = int(max(y_true.max(initial=-1), y_pred.max(initial=-1))) + 1
+    for name, values in (('y_true', y_true), ('y_pred', y_pred)):
+        if values.size and (values.min() < 0 or values.max() >= num_classes):
+            raise ValueError(f"{name} has labels outside [0, {num_classes}): "
+                             f"min {values.min()}, max {values.max()}")
+    flat = np.bincount(y_true * num_classes + y_pred, minlength=num_classes * num_classes)
+    return flat.reshape(num_classes, num_classes)
+
+
+def metrics_from_confusion_matrix(cm: np.ndarray) -> Dict:
+    """Derive accuracy and precision/recall/F1 from a confusion matrix.
+
+    Returns weighted averages under ``precision``/``recall``/``f1`` (as
+    ``calculate_model_metrics`` always has), macro averages over the
+    classes that occur, and per-class arrays. Undefined ratios count as 0,
+    like sklearn's default.
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    true_positives = np.diag(cm)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    total = support.sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+        recall = np.where(support > 0, true_positives / support, 0.0)
+        denom = precision + recall
+        f1 = np.where(denom > 0, 2 * precision * recall / denom, 0.0)
+
+    present = (support > 0) | (predicted > 0)
+    weights = support / total if total else support
 
+    return {
+        'accuracy': float(true_positives.sum() / total) if total else 0.0,
+        'precision': float(precision @ weights),
+        'recall': float(recall @ weights),
+        'f1': float(f1 @ weights),
+        'macro_precision': float(precision[present].mean()) if present.any() else 0.0,
+        'macro_recall': float(recall[present].mean()) if present.any() else 0.0,
+        'macro_f1': float(f1[present].mean()) if present.any() else 0.0,
+        'per_class_precision': precision,
+        'per_class_recall': recall,
+        'per_class_f1': f1,
+        'support': support.astype(np.int64),
+    }
 
-def plot_confusion_matrix(y_true: List[int], y_pred: List[int], labels: List[str] = None):
-    """Plot a confusion matrix."""
-    cm = confusion_matrix(y_true, y_pred)
 
-    plt.figure(figsize=(8, 6))
-    sns.heatmap(cm, annot=True, fmt='d', cmap='Blues',
+def format_classification_report(cm: np.ndarray, labels: List[str] = None) -> str:
+    """Format a confusion matrix as an sklearn-style classification report."""
+    metrics = metrics_from_confusion_matrix(cm)
+    support = metrics['support']
+    total = int(support.sum())
+    names = [labels[i] if labels and i < len(labels) else str(i) for i in range(len(cm))]
+    width = max([len(name) for name in names] + [len('weighted avg')])
+
+    lines = [f"{'':>{width}} {'precision':>9} {'recall':>9} {'f1-score':>9} {'support':>9}", ""]
+    for i, name in enumerate(names):
+        if support[i] == 0 and cm[:, i].sum() == 0:
+            continue
+        lines.append(f"{name:>{width}} {metrics['per_class_precision'][i]:>9.2f} "
+                     f"{metrics['per_class_recall'][i]:>9.2f} "
+                     f"{metrics['per_class_f1'][i]:>9.2f} {support[i]:>9}")
+    lines.append("")
+    lines.append(f"{'accuracy':>{width}} {'':>9} {'':>9} {metrics['accuracy']:>9.2f} {total:>9}")
+    lines.append(f"{'macro avg':>{width}} {metrics['macro_precision']:>9.2f} "
+                 f"{metrics['macro_recall']:>9.2f} {metrics['macro_f1']:>9.2f} {total:>9}")
+    lines.append(f"{'weighted avg':>{width}} {metrics['precision']:>9.2f} "
+                 f"{metrics['recall']:>9.2f} {metrics['f1']:>9.2f} {total:>9}")
+    return "\n".join(lines)
+
+
+def plot_confusion_matrix(y_true: List[int] = None, y_pred: List[int] = None,
+                          labels: List[str] = None, cm: np.ndarray = None,
+                          save_path=None, format: str = None):
+    """Plot a confusion matrix.
+
+    Pass a precomputed ``cm`` (e.g. from ``analyze_predictions``) to skip
+    recomputing it from ``y_true``/``y_pred``. ``save_path`` and ``format``
+    render headlessly, as in ``plot_training_history``.
+    """
+    if cm is None:
+        cm = compute_confusion_matrix(y_true, y_pred, len(labels) if labels else None)
+
+    import seaborn as sns
+
+    fig = _new_figure(headless=save_path is not None, figsize=(8, 6))
+    ax = fig.add_subplot()
+    sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', ax=ax,
                 xticklabels=labels or range(len(cm)),
                 yticklabels=labels or range(len(cm)))
-    plt.xlabel('Predicted')
-    plt.ylabel('True')
-    plt.title('Confusion Matrix')
-    plt.show()
+    ax.set_xlabel('Predicted')
+    ax.set_ylabel('True')
+    ax.set_title('Confusion Matrix')
+    _finish_figure(fig, save_path, format)
 
     return cm
 
 
 def analyze_predictions(y_true: List[int], y_pred: List[int],
-                       texts: List[str] = None, labels: List[str] = None):
-    """Analyze model predictions and show classification report."""
+                       texts: List[str] = None, labels: List[str] = None,
+                       confidences: List[float] = None, num_examples: int = 5) -> np.ndarray:
+    """Analyze model predictions and show classification report.
+
+    Misclassified examples are found with a vectorized mask; when
+    ``confidences`` are given the most confident mistakes are shown first.
+    Returns the confusion matrix so it can be reused by
+    ``plot_confusion_matrix`` and ``metrics_from_confusion_matrix``.
+    """
+    y_true = np.asarray(y_true, dtype=np.int64)
+    y_pred = np.asarray(y_pred, dtype=np.int64)
+    cm = compute_confusion_matrix(y_true, y_pred, len(labels) if labels else None)
+
     print("=" * 60)
     print("CLASSIFICATION REPORT")
     print("=" * 60)
-    print(classification_report(y_true, y_pred, target_names=labels))
+    print(format_classification_report(cm, labels))
     print("=" * 60)
 
     # Show some misclassified examples if texts provided
-    if texts:
-        misclassified = [(i, texts[i], y_true[i], y_pred[i])
-                        for i in range(len(texts))
-                        if y_true[i] != y_pred[i]]
-
-        if misclassified:
-            print(f"\nSample Misclassified Examples (showing up to 5):\n")
-            for idx, text, true_label, pred_label in misclassified[:5]:
-                label_names = labels or ["Label"]
-                true_name = label_names[true_label] if labels else true_label
-                pred_name = label_names[pred_label] if labels else pred_label
+    if texts is not None and len(texts):
+        misclassified = np.flatnonzero(y_true != y_pred)
+        if confidences is not None:
+            scores = np.asarray(confidences)[misclassified]
+            misclassified = misclassified[np.argsort(-scores, kind='stable')]
+
+        if misclassified.size:
+            print(f"\nSample Misclassified Examples (showing up to {num_examples}):\n")
+            for idx in misclassified[:num_examples]:
+                true_label, pred_label = y_true[idx], y_pred[idx]
+                true_name = labels[true_label] if labels else true_label
+                pred_name = labels[pred_label] if labels else pred_label
                 print(f"Example {idx}:")
-                print(f"  Text: {text[:100]}...")
-                print(f"  True: {true_name} | Predicted: {pred_name}\n")
+                print(f"  Text: {texts[idx][:100]}...")
+                if confidences is not None:
+                    print(f"  True: {true_name} | Predicted: {pred_name} "
+                          f"(confidence {confidences[idx]:.2f})\n")
+                else:
+                    print(f"  True: {true_name} | Predicted: {pred_name}\n")
+
+    return cm
 
 
 def calculate_model_metrics(predictions: np.ndarray, labels: np.ndarray) -> Dict:
     """Calculate various metrics for model evaluation."""
-    from sklearn.metrics import accuracy_score, precision_recall_fscore_support
-
     preds = np.argmax(predictions, axis=1)
-
-    accuracy = accuracy_score(labels, preds)
-    precision, recall, f1, _ = precision_recall_fscore_support(
-        labels, preds, average='weighted'
-    )
+    cm = compute_confusion_matrix(labels, preds, predictions.shape[1])
+    metrics = metrics_from_confusion_matrix(cm)
 
     return {
-        'accuracy': accuracy,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1
+        'accuracy': metrics['accuracy'],
+        'precision': metrics['precision'],
+        'recall': metrics['recall'],
+        'f1': metrics['f1']
     }
 
 
-def predict_with_model(text: str, model, tokenizer, device='cpu'):
-    """Make a prediction on a single text."""
+class StreamingMetrics:
+    """Accumulate a confusion matrix batch by batch instead of holding all logits.
+
+    Call ``update`` with each batch of labels and either logits or
+    already-decoded predictions (e.g. the chunks yielded by
+    ``iter_batch_predict``); ``compute`` returns the same dict as
+    ``metrics_from_confusion_matrix`` at any point. Memory is O(C^2).
+    """
+
+    def __init__(self, num_classes: int):
+        self.num_classes = num_classes
+        self.confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, labels, logits=None, predictions=None):
+        """Add one batch; pass ``logits`` of shape (batch, C) or ``predictions``."""
+        if (logits is None) == (predictions is None):
+            raise ValueError("Pass exactly one of logits or predictions")
+        if logits is not None:
+            if isinstance(logits, torch.Tensor):
+                predictions = logits.argmax(dim=-1)
+            else:
+                predictions = np.asarray(logits).argmax(axis=-1)
+        if isinstance(predictions, torch.Tensor):
+            predictions = predictions.cpu().numpy()
+        if isinstance(labels, torch.Tensor):
+            labels = labels.cpu().numpy()
+        self.confusion_matrix += compute_confusion_matrix(labels, predictions, self.num_classes)
+
+    @property
+    def count(self) -> int:
+        return int(self.confusion_matrix.sum())
+
+    def compute(self) -> Dict:
+        """Return accuracy and weighted/macro/per-class metrics seen so far."""
+        return metrics_from_confusion_matrix(self.confusion_matrix)
+
+    def reset(self):
+        self.confusion_matrix[:] = 0
+
+
+def _logits_to_predictions(logits: torch.Tensor, top_k: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Turn logits into (labels, confidences) without materializing a softmax.
+
+    The softmax probability of a class is ``exp(logit - logsumexp(logits))``,
+    so only the winning logits need exponentiating. With ``top_k > 1`` both
+    outputs have shape ``(batch, top_k)``, best first.
+    """
+    log_norm = torch.logsumexp(logits, dim=-1)
+    if top_k == 1:
+        top_logits, labels = logits.max(dim=-1)
+        return labels, torch.exp(top_logits - log_norm)
+    top_logits, labels = logits.topk(top_k, dim=-1)
+    return labels, torch.exp(top_logits - log_norm.unsqueeze(-1))
+
+
+class MetricsRegistry:
+    """Minimal thread-safe registry of counters and histograms.
+
+    Metrics are identified by name plus an optional dict of labels.
+    Export with ``to_dict``/``to_json`` or ``to_prometheus`` (the
+    Prometheus text exposition format, ready to serve from ``/metrics``).
+    """
+
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+    RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict = None):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name: str, value: float = 1, labels: Dict = None):
+        """Add ``value`` to a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: Dict = None,
+                buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """Record one observation in a histogram (buckets fixed on first use)."""
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {
+                    'buckets': tuple(buckets), 'counts': [0] * len(buckets),
+                    'sum': 0.0, 'count': 0,
+                }
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    @contextmanager
+    def time(self, name: str, labels: Dict = None):
+        """Context manager recording the elapsed seconds in histogram ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def to_dict(self) -> Dict:
+        """Return all metrics as plain Python data."""
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in self._counters.items()]
+            histograms = []
+            for (name, labels), hist in self._histograms.items():
+                histograms.append({
+                    'name': name, 'labels': dict(labels),
+                    'count': hist['count'], 'sum': hist['sum'],
+                    'mean': hist['sum'] / hist['count'] if hist['count'] else 0.0,
+                    'buckets': dict(zip(hist['buckets'], hist['counts'])),
+                })
+        return {'counters': counters, 'histograms': histograms}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+    def to_prometheus(self, prefix: str = '') -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        def fmt_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    seen.add(name)
+                lines.append(f"{prefix}{name}{fmt_labels(labels)} {value}")
+
+            for (name, labels), hist in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(hist['buckets'], hist['counts']):
+                    cumulative += count
+                    lines.append(f"{prefix}{name}_bucket"
+                                 f"{fmt_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{prefix}{name}_bucket"
+                             f"{fmt_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{prefix}{name}_sum{fmt_labels(labels)} {hist['sum']}")
+                lines.append(f"{prefix}{name}_count{fmt_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry the prediction helpers report into; None means instrumentation is off
+_ACTIVE_REGISTRY = None
+_NO_TIMER = nullcontext()
+
+
+def enable_instrumentation(registry: MetricsRegistry = None) -> MetricsRegistry:
+    """Start recording prediction-helper metrics and return the registry.
+
+    ``predict_with_model`` and ``batch_predict`` then record per-stage
+    timings (tokenize, h2d, forward, postprocess) in
+    ``inference_stage_seconds`` plus batch sizes, pad ratios and example
+    counts. Workers of ``parallel_batch_predict`` record into their own
+    process, not this registry.
+    """
+    global _ACTIVE_REGISTRY
+    _ACTIVE_REGISTRY = registry or MetricsRegistry()
+    return _ACTIVE_REGISTRY
+
+
+def disable_instrumentation():
+    """Stop recording prediction-helper metrics."""
+    global _ACTIVE_REGISTRY
+    _ACTIVE_REGISTRY = None
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    """Return the active registry, or None when instrumentation is off."""
+    return _ACTIVE_REGISTRY
+
+
+def _timed(registry, function: str, stage: str):
+    """Time a stage into ``registry``, or do nothing if it is None."""
+    if registry is None:
+        return _NO_TIMER
+    return registry.time('inference_stage_seconds', {'function': function, 'stage': stage})
+
+
+class PredictionCache:
+    """LRU cache for ``predict_with_model`` results.
+
+    Entries are keyed by a fingerprint of the model's weights plus the
+    normalized text (Unicode NFKC, collapsed whitespace, optionally
+    lowercased for uncased models). The in-memory tier holds at most ``max_size`` entries; ``ttl_seconds``
+    expires stale ones, and ``db_path`` adds a sqlite tier that survives
+    restarts and is consulted on memory misses. Counters are available
+    from ``stats()`` for monitoring.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = None,
+                 db_path: str = None, lowercase: bool = False):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lowercase = lowercase
+        self._entries = OrderedDict()
+        self._model_ids = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._db = None
+        if db_path is not None:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key TEXT PRIMARY KEY, created REAL, prediction INTEGER, "
+                "confidence REAL, probabilities BLOB)"
+            )
+            self._db.commit()
+
+    def normalize(self, text: str) -> str:
+        """Normalize text so trivially different inputs share an entry."""
+        text = ' '.join(unicodedata.normalize('NFKC', text).split())
+        return text.lower() if self.lowercase else text
+
+    def model_id(self, model) -> str:
+        """Identity of ``model``'s weights, computed once per model object.
+
+        PyTorch models are identified by ``_model_fingerprint`` and ONNX
+        backends by a hash of their ``.onnx`` file, so models fine-tuned
+        from the same checkpoint never share entries. The fingerprint is
+        remembered for the model's lifetime; call ``refresh_model`` after
+        changing its weights in place.
+        """
+        model_id = self._model_ids.get(model)
+        if model_id is None:
+            if hasattr(model, 'state_dict'):
+                model_id = _model_fingerprint(model)
+            elif getattr(model, 'onnx_path', None):
+                file_hash = hashlib.sha256()
+                with open(model.onnx_path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        file_hash.update(block)
+                model_id = file_hash.hexdigest()
+            else:
+                raise TypeError(f"Can't identify the weights of a {model.__class__.__name__}")
+            self._model_ids[model] = model_id
+        return model_id
+
+    def refresh_model(self, model):
+        """Forget ``model``'s fingerprint so the next lookup recomputes it."""
+        self._model_ids.pop(model, None)
+
+    def make_key(self, model, text: str) -> str:
+        """Build a cache key from the model's weight fingerprint and the normalized text."""
+        model_id = self.model_id(model)
+        # PEFT models keep every loaded adapter; only the active one runs.
+        # Plain transformers 4.x models also have ``active_adapter``, as a method.
+        if hasattr(model, 'peft_config'):
+            adapter = model.active_adapter
+            if isinstance(adapter, (list, tuple)):
+                adapter = ','.join(adapter)
+            if isinstance(adapter, str):
+                model_id += f":{adapter}"
+        raw = f"{model_id}\0{self.normalize(text)}".encode('utf-8')
+        return hashlib.sha256(raw).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created > self.ttl_seconds
+
+    def get(self, key: str):
+        """Return the cached ``(prediction, confidence, probabilities)`` or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value[0], value[1], value[2].copy()
+                del self._entries[key]
+                self.expirations += 1
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, prediction, confidence, probabilities "
+                    "FROM predictions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    value = (row[1], row[2], np.frombuffer(row[3], dtype=np.float32))
+                    self._store(key, row[0], value)
+                    self.disk_hits += 1
+                    return value[0], value[1], value[2].copy()
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: Tuple[int, float, np.ndarray]):
+        """Store a ``(prediction, confidence, probabilities)`` result."""
+        prediction, confidence, probabilities = value
+        value = (int(prediction), float(confidence),
+                 np.asarray(probabilities, dtype=np.float32).copy())
+        created = time.time()
+        with self._lock:
+            self._store(key, created, value)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                    (key, created, value[0], value[1], value[2].tobytes())
+                )
+                self._db.commit()
+
+    def _store(self, key: str, created: float, value):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every entry from both tiers (counters are kept)."""
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions")
+                self._db.commit()
+
+    def stats(self) -> Dict:
+        """Return hit/miss/eviction counters and the current size."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._entries),
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+def predict_with_model(text: str, model, tokenizer, device='cpu',
+                       cache: PredictionCache = None):
+    """Make a prediction on a single text.
+
+    Pass a ``PredictionCache`` to skip the forward pass for texts that
+    were already scored by the same model.
+    """
+    registry = _ACTIVE_REGISTRY
+    if cache is not None:
+        key = cache.make_key(model, text)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
     # Tokenize
-    inputs = tokenizer(text, return_tensors="pt", truncation=True,
-                      padding=True, max_length=512)
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    with _timed(registry, 'predict_with_model', 'tokenize'):
+        inputs = tokenizer(text, return_tensors="pt", truncation=True, max_length=512)
+    with _timed(registry, 'predict_with_model', 'h2d'):
+        inputs = inputs.to(device)
 
     # Predict
-    model.eval()
-    with torch.no_grad():
+    if model.training:
+        model.eval()
+    with _timed(registry, 'predict_with_model', 'forward'), torch.inference_mode():
         outputs = model(**inputs)
 
     # Get probabilities
-    probabilities = torch.nn.functional.softmax(outputs.logits, dim=-1)
-    prediction = torch.argmax(probabilities, dim=-1).item()
-    confidence = probabilities[0][prediction].item()
+    with _timed(registry, 'predict_with_model', 'postprocess'):
+        probabilities = torch.nn.functional.softmax(outputs.logits[0], dim=-1)
+        confidence, prediction = probabilities.max(dim=-1)
+        result = (prediction.item(), confidence.item(), probabilities.float().cpu().numpy())
+
+    if registry is not None:
+        registry.inc('inference_examples_total', 1, {'function': 'predict_with_model'})
+
+    if cache is not None:
+        cache.put(key, result)
+
+    return result
+
+
+class TokenizedTexts:
+    """Unpadded token ids for a list of texts, stored as flat ragged arrays.
+
+    Each array in ``arrays`` (``input_ids`` and, if the tokenizer produces
+    them, ``token_type_ids``) holds every example back to back;
+    ``offsets[i]:offsets[i + 1]`` is example ``i``. Batches are padded on
+    demand with ``pad``. Use ``pretokenize`` to build one, optionally
+    cached on disk.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray], offsets: np.ndarray):
+        self.arrays = arrays
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_encodings(cls, encodings) -> 'TokenizedTexts':
+        """Build from unpadded tokenizer output (a dict of lists of lists)."""
+        lengths = [len(ids) for ids in encodings['input_ids']]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        arrays = {}
+        for key, values in encodings.items():
+            if key == 'attention_mask':
+                continue  # rebuilt from lengths when padding
+            flat = [token for row in values for token in row]
+            arrays[key] = np.asarray(flat, dtype=np.int32)
+        return cls(arrays, offsets)
+
+    def pad(self, indices, pad_token_id: int = 0,
+            padding_side: str = 'right') -> Dict[str, torch.Tensor]:
+        """Pad the selected examples to their longest member."""
+        lengths = self.offsets[np.asarray(indices) + 1] - self.offsets[indices]
+        width = int(lengths.max()) if len(lengths) else 0
+        batch = {key: np.full((len(lengths), width), pad_token_id if key == 'input_ids' else 0,
+                              dtype=np.int64)
+                 for key in self.arrays}
+        attention_mask = np.zeros((len(lengths), width), dtype=np.int64)
+
+        for row, (idx, length) in enumerate(zip(indices, lengths)):
+            start = self.offsets[idx]
+            cols = slice(width - length, width) if padding_side == 'left' else slice(0, length)
+            for key, flat in self.arrays.items():
+                batch[key][row, cols] = flat[start:start + length]
+            attention_mask[row, cols] = 1
+
+        batch['attention_mask'] = attention_mask
+        return {key: torch.from_numpy(value) for key, value in batch.items()}
+
+    def save(self, path: str):
+        """Write the arrays as ``.npy`` files into directory ``path``."""
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'offsets.npy'), self.offsets)
+        for key, flat in self.arrays.items():
+            np.save(os.path.join(path, f'{key}.npy'), flat)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'TokenizedTexts':
+        """Load a directory written by ``save``, memory-mapped by default."""
+        mode = 'r' if mmap else None
+        offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode=mode)
+        arrays = {}
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.npy') and name != 'offsets.npy':
+                arrays[name[:-4]] = np.load(os.path.join(path, name), mmap_mode=mode)
+        return cls(arrays, offsets)
+
+
+def pretokenize(texts: List[str], tokenizer, max_length: int = 512,
+                cache_dir: str = None) -> TokenizedTexts:
+    """Tokenize texts once into a ``TokenizedTexts`` for ``batch_predict``.
+
+    With ``cache_dir`` the result is stored under a key built from the
+    tokenizer name, vocabulary size, ``max_length`` and a hash of the
+    texts, and later calls with the same inputs load it memory-mapped
+    instead of tokenizing again.
+    """
+    cache_path = None
+    if cache_dir is not None:
+        content_hash = hashlib.sha256()
+        for text in texts:
+            content_hash.update(text.encode('utf-8'))
+            content_hash.update(b'\0')
+        key = hashlib.sha256(
+            f"{tokenizer.__class__.__name__}:{tokenizer.name_or_path}:{len(tokenizer)}:"
+            f"{max_length}:{content_hash.hexdigest()}".encode('utf-8')
+        ).hexdigest()
+        cache_path = os.path.join(cache_dir, key)
+        if os.path.exists(os.path.join(cache_path, 'offsets.npy')):
+            return TokenizedTexts.load(cache_path)
+
+    tokenized = TokenizedTexts.from_encodings(
+        tokenizer(texts, truncation=True, max_length=max_length)
+    )
 
-    return prediction, confidence, probabilities[0].cpu().numpy()
+    if cache_path is not None:
+        # Write to a scratch directory first so readers never see a partial entry
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        tokenized.save(tmp_path)
+        os.replace(tmp_path, cache_path)
+        return TokenizedTexts.load(cache_path)
+    return tokenized
+
+
+def _plan_batches(order: np.ndarray, batch_size: int, lengths: List[int] = None,
+                  max_tokens_per_batch: int = None) -> List[np.ndarray]:
+    """Split an ordering of example indices into batches.
+
+    Batches hold ``batch_size`` examples, or, when ``max_tokens_per_batch``
+    is given, as many examples as fit in that many padded tokens
+    (batch size x longest member). An example longer than the budget gets
+    a batch of its own.
+    """
+    if max_tokens_per_batch is None:
+        return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+    batches = []
+    current, longest = [], 0
+    for idx in order:
+        new_longest = max(longest, lengths[idx])
+        if current and new_longest * (len(current) + 1) > max_tokens_per_batch:
+            batches.append(np.array(current))
+            current, new_longest = [], lengths[idx]
+        current.append(idx)
+        longest = new_longest
+    if current:
+        batches.append(np.array(current))
+    return batches
+
+
+def _prefetched(fn, items: Iterable, depth: int) -> Iterator:
+    """Yield ``fn(item)`` for each item, computing up to ``depth`` results ahead.
+
+    Work runs on a single background thread so the caller can keep the
+    model busy meanwhile. One thread is deliberate: fast tokenizers release
+    the GIL but are not safe to call concurrently with truncation/padding.
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def batch_predict(texts: Union[List[str], TokenizedTexts], model, tokenizer,
+                  batch_size=16, device='cpu',
+                  sort_by_length: bool = False, max_tokens_per_batch: int = None,
+                  return_stats: bool = False, prefetch: int = 0, top_k: int = 1):
+    """Make predictions on a batch of texts.
+
+    With ``sort_by_length=True`` texts are grouped by token length so each
+    batch is only padded to its own longest member. With
+    ``max_tokens_per_batch`` batches are packed up to a padded-token budget
+    instead of a fixed ``batch_size`` (which is then ignored); combine it
+    with ``sort_by_length`` for the tightest packing. Predictions and
+    confidences are returned as numpy arrays in the original input order;
+    with ``top_k > 1`` they have shape ``(len(texts), top_k)``, best first.
+
+    ``texts`` may also be a ``TokenizedTexts`` from ``pretokenize``, in
+    which case tokenization is skipped entirely.
+
+    With ``prefetch > 0`` tokenization and the copy to ``device`` run on a
+    background thread up to ``prefetch`` batches ahead of the forward pass,
+    so the model does not sit idle waiting on the tokenizer.
+
+    If ``return_stats`` is True a third value is returned: one dict per
+    batch with ``examples``, ``padded_tokens``, ``real_tokens`` and
+    ``pad_ratio``.
+    """
+    registry = _ACTIVE_REGISTRY
+    result_shape = (len(texts),) if top_k == 1 else (len(texts), top_k)
+    all_predictions = np.empty(result_shape, dtype=np.int64)
+    all_confidences = np.empty(result_shape, dtype=np.float32)
+    batch_stats = []
+
+    prepared_batches = _prepared_batches(texts, tokenizer, batch_size, device, sort_by_length,
+                                         max_tokens_per_batch, prefetch, registry, 'batch_predict')
+
+    if model.training:
+        model.eval()
+
+    for batch_indices, inputs in prepared_batches:
+        if return_stats or registry is not None:
+            stats = _record_batch_stats(inputs, len(batch_indices), registry, 'batch_predict')
+            if return_stats:
+                batch_stats.append(stats)
 
+        # Predict
+        with _timed(registry, 'batch_predict', 'forward'), torch.inference_mode():
+            outputs = model(**inputs)
 
-def batch_predict(texts: List[str], model, tokenizer, batch_size=16, device='cpu'):
-    """Make predictions on a batch of texts."""
-    all_predictions = []
-    all_confidences = []
+        with _timed(registry, 'batch_predict', 'postprocess'):
+            predictions, confidences = _logits_to_predictions(outputs.logits, top_k)
+            # Writing by index also undoes any length sort
+            all_predictions[batch_indices] = predictions.cpu().numpy()
+            all_confidences[batch_indices] = confidences.float().cpu().numpy()
 
-    model.eval()
+    if return_stats:
+        return all_predictions, all_confidences, batch_stats
+    return all_predictions, all_confidences
+
+
+def _prepared_batches(texts: Union[List[str], TokenizedTexts], tokenizer, batch_size: int,
+                      device, sort_by_length: bool, max_tokens_per_batch: int, prefetch: int,
+                      registry, function: str) -> Iterator[Tuple[np.ndarray, Dict]]:
+    """Plan batches over ``texts`` and yield ``(indices, inputs on device)`` for each.
+
+    Shared by the batched prediction functions; see ``batch_predict`` for
+    what the batching options do.
+    """
+    if len(texts) == 0:
+        return iter(())
+    if isinstance(texts, TokenizedTexts):
+        encodings = texts
+    elif sort_by_length or max_tokens_per_batch is not None:
+        # Tokenize once without padding, then pad each batch on its own
+        encodings = TokenizedTexts.from_encodings(
+            tokenizer(texts, truncation=True, max_length=512)
+        )
+    else:
+        encodings = None
+    pretokenized = encodings is not None
+    lengths = encodings.lengths if pretokenized else None
+
+    if sort_by_length:
+        order = np.argsort(lengths, kind='stable')
+    else:
+        order = np.arange(len(texts))
 
-    for i in range(0, len(texts), batch_size):
-        batch_texts = texts[i:i + batch_size]
+    batches = _plan_batches(order, batch_size, lengths, max_tokens_per_batch)
 
+    def prepare(batch_indices):
         # Tokenize
-        inputs = tokenizer(batch_texts, return_tensors="pt", truncation=True,
-                         padding=True, max_length=512)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        with _timed(registry, function, 'tokenize'):
+            if pretokenized:
+                inputs = encodings.pad(batch_indices, tokenizer.pad_token_id or 0,
+                                       tokenizer.padding_side)
+            else:
+                batch_texts = [texts[j] for j in batch_indices]
+                inputs = tokenizer(batch_texts, return_tensors="pt", truncation=True,
+                                 padding=True, max_length=512)
+        with _timed(registry, function, 'h2d'):
+            inputs = {k: v.to(device) for k, v in inputs.items()}
+        return batch_indices, inputs
+
+    if prefetch > 0:
+        return _prefetched(prepare, batches, prefetch)
+    return map(prepare, batches)
+
+
+def _record_batch_stats(inputs: Dict, examples: int, registry, function: str) -> Dict:
+    """Compute one batch's padding stats and record them in ``registry`` if set."""
+    padded_tokens = inputs['input_ids'].numel()
+    if 'attention_mask' in inputs:
+        real_tokens = int(inputs['attention_mask'].sum().item())
+    else:
+        real_tokens = padded_tokens
+    stats = {
+        'examples': examples,
+        'padded_tokens': padded_tokens,
+        'real_tokens': real_tokens,
+        'pad_ratio': 1 - real_tokens / padded_tokens if padded_tokens else 0.0,
+    }
+    if registry is not None:
+        labels = {'function': function}
+        registry.inc('inference_examples_total', examples, labels)
+        registry.inc('inference_batches_total', 1, labels)
+        registry.inc('inference_padded_tokens_total', padded_tokens, labels)
+        registry.observe('inference_batch_size', examples, labels,
+                         MetricsRegistry.BATCH_SIZE_BUCKETS)
+        registry.observe('inference_pad_ratio', stats['pad_ratio'], labels,
+                         MetricsRegistry.RATIO_BUCKETS)
+    return stats
+
+
+def multitask_batch_predict(texts: Union[List[str], TokenizedTexts], model, tokenizer,
+                            tasks: List[str] = None, batch_size=16, device='cpu',
+                            sort_by_length: bool = False, max_tokens_per_batch: int = None,
+                            return_stats: bool = False, prefetch: int = 0,
+                            top_k: int = 1) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Predict every task head of a multi-task model in one encoder pass per batch.
+
+    ``model`` follows the lessons' ``MultiTaskModel``: a shared ``encoder``
+    returning ``last_hidden_state`` and a ``task_heads`` ``ModuleDict``
+    applied to the first-token state. Each batch runs the encoder once and
+    feeds the pooled states to every head in ``tasks`` (default: all), so
+    scoring N tasks costs one encoder pass instead of N. Batching options
+    behave as in ``batch_predict``.
+
+    Returns ``{task: (predictions, confidences)}`` with arrays in input
+    order, plus the per-batch stats list when ``return_stats`` is True.
+    """
+    registry = _ACTIVE_REGISTRY
+    tasks = list(model.task_heads.keys()) if tasks is None else list(tasks)
+    unknown = [task for task in tasks if task not in model.task_heads]
+    if unknown:
+        raise ValueError(f"Unknown tasks: {unknown} (model has {list(model.task_heads.keys())})")
+
+    result_shape = (len(texts),) if top_k == 1 else (len(texts), top_k)
+    results = {task: (np.empty(result_shape, dtype=np.int64),
+                      np.empty(result_shape, dtype=np.float32)) for task in tasks}
+    batch_stats = []
+
+    prepared_batches = _prepared_batches(texts, tokenizer, batch_size, device, sort_by_length,
+                                         max_tokens_per_batch, prefetch, registry,
+                                         'multitask_batch_predict')
+
+    if model.training:
+        model.eval()
+
+    for batch_indices, inputs in prepared_batches:
+        if return_stats or registry is not None:
+            stats = _record_batch_stats(inputs, len(batch_indices), registry,
+                                        'multitask_batch_predict')
+            if return_stats:
+                batch_stats.append(stats)
+
+        with _timed(registry, 'multitask_batch_predict', 'forward'), torch.inference_mode():
+            pooled = model.encoder(**inputs).last_hidden_state[:, 0]
+            logits = {task: model.task_heads[task](pooled) for task in tasks}
+
+        with _timed(registry, 'multitask_batch_predict', 'postprocess'):
+            for task, task_logits in logits.items():
+                predictions, confidences = _logits_to_predictions(task_logits, top_k)
+                results[task][0][batch_indices] = predictions.cpu().numpy()
+                results[task][1][batch_indices] = confidences.float().cpu().numpy()
+
+    if return_stats:
+        return results, batch_stats
+    return results
+
+
+# Set in the parent right before forking so workers inherit the model
+# copy-on-write instead of unpickling their own copy.
+_WORKER_STATE = {}
+
+
+def _init_predict_worker(model, tokenizer, num_threads, batch_kwargs):
+    """Process-pool initializer: pin torch threads and stash the model."""
+    torch.set_num_threads(num_threads)
+    if model is not None:
+        _WORKER_STATE.update(model=model, tokenizer=tokenizer, batch_kwargs=batch_kwargs)
+
+
+def _predict_shard(texts: List[str]):
+    """Run ``batch_predict`` on one shard inside a worker process."""
+    state = _WORKER_STATE
+    return batch_predict(texts, state['model'], state['tokenizer'], **state['batch_kwargs'])
+
+
+def parallel_batch_predict(texts: List[str], model, tokenizer, num_workers: int = None,
+                           threads_per_worker: int = None, shard_size: int = 256,
+                           **batch_kwargs):
+    """Make predictions with a pool of CPU worker processes.
+
+    The input is split into shards of ``shard_size`` texts which are handed
+    out to ``num_workers`` processes (default: one per core), each running
+    ``batch_predict`` with ``threads_per_worker`` torch threads (default:
+    cores divided evenly between workers). Remaining keyword arguments go
+    to ``batch_predict``. Results are merged back in input order and
+    returned in the same shape as ``batch_predict``.
+
+    Where ``fork`` is available the workers share the parent's weights
+    copy-on-write; otherwise the model is pickled once per worker.
+    """
+    cpu_count = os.cpu_count() or 1
+    num_workers = num_workers or cpu_count
+    threads_per_worker = threads_per_worker or max(1, cpu_count // num_workers)
+    batch_kwargs['device'] = 'cpu'
+    model.eval()
 
-        # Predict
-        with torch.no_grad():
-            outputs = model(**inputs)
+    shards = [texts[i:i + shard_size] for i in range(0, len(texts), shard_size)]
 
-        # Get probabilities
-        probabilities = torch.nn.functional.softmax(outputs.logits, dim=-1)
-        predictions = torch.argmax(probabilities, dim=-1)
-        confidences = probabilities.gather(1, predictions.unsqueeze(1)).squeeze()
+    if 'fork' in mp.get_all_start_methods():
+        ctx = mp.get_context('fork')
+        _WORKER_STATE.update(model=model, tokenizer=tokenizer, batch_kwargs=batch_kwargs)
+        initargs = (None, None, threads_per_worker, None)
+    else:
+        ctx = mp.get_context('spawn')
+        initargs = (model, tokenizer, threads_per_worker, batch_kwargs)
 
-        all_predictions.extend(predictions.cpu().numpy())
-        all_confidences.extend(confidences.cpu().numpy())
+    all_predictions = []
+    all_confidences = []
+    batch_stats = []
+    try:
+        with ctx.Pool(num_workers, initializer=_init_predict_worker, initargs=initargs) as pool:
+            # imap keeps shard order, so results line up with ``texts``
+            for result in pool.imap(_predict_shard, shards):
+                all_predictions.append(result[0])
+                all_confidences.append(result[1])
+                if len(result) > 2:
+                    batch_stats.extend(result[2])
+    finally:
+        _WORKER_STATE.clear()
+
+    if shards:
+        all_predictions = np.concatenate(all_predictions)
+        all_confidences = np.concatenate(all_confidences)
+    else:
+        all_predictions = np.empty(0, dtype=np.int64)
+        all_confidences = np.empty(0, dtype=np.float32)
 
+    if batch_kwargs.get('return_stats'):
+        return all_predictions, all_confidences, batch_stats
     return all_predictions, all_confidences
 
 
+def _iter_text_chunks(source, text_column: str, chunk_size: int) -> Iterator[List[str]]:
+    """Yield lists of at most ``chunk_size`` texts from any supported source."""
+    if isinstance(source, str):
+        binary = source.endswith('.json')
+        with (open(source, 'rb') if binary else open(source, newline='', encoding='utf-8')) as f:
+            if source.endswith('.csv'):
+                rows = (row[text_column] for row in csv.DictReader(f))
+            elif source.endswith('.jsonl'):
+                rows = (json.loads(line)[text_column] for line in f if line.strip())
+            elif source.endswith('.json'):
+                # A JSON array of records (or of strings), streamed with ijson if installed
+                if _first_json_byte(f) != b'[':
+                    raise ValueError(f"{source} does not hold a JSON array")
+                try:
+                    import ijson
+                    records = ijson.items(f, 'item')
+                except ImportError:
+                    records = json.load(f)
+                rows = (row[text_column] if isinstance(row, dict) else row for row in records)
+            else:
+                raise ValueError(f"Unsupported file type: {source} (expected .csv, .jsonl or .json)")
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    return
+                yield chunk
+
+    elif hasattr(source, 'column_names') and hasattr(source, 'select_columns'):
+        # HuggingFace Dataset: read only the text column, one slice at a time
+        for batch in source.select_columns([text_column]).iter(batch_size=chunk_size):
+            yield batch[text_column]
+
+    else:
+        rows = (row[text_column] if isinstance(row, dict) else row for row in source)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_batch_predict(source, model, tokenizer, text_column: str = 'text',
+                       chunk_size: int = 10000, output_path: str = None,
+                       **batch_kwargs) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """Stream predictions over a dataset that does not fit in memory.
+
+    ``source`` can be any iterable of texts (or of dicts with a
+    ``text_column`` key), a HuggingFace ``Dataset``, or a path to a CSV,
+    JSONL or JSON-array file. Texts are read ``chunk_size`` at a time and run through
+    ``batch_predict`` (extra keyword arguments such as ``batch_size``,
+    ``device``, ``sort_by_length`` or ``max_tokens_per_batch`` are passed
+    on), and a ``(predictions, confidences)`` pair of numpy arrays is
+    yielded per chunk.
+
+    If ``output_path`` is given, each chunk is also appended to a Parquet
+    file as its own row group. The file is complete once the generator has
+    been exhausted.
+    """
+    writer = None
+    if output_path is not None:
+        if batch_kwargs.get('top_k', 1) > 1:
+            raise ValueError("output_path only supports top_k=1")
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([('prediction', pa.int64()), ('confidence', pa.float32())])
+        writer = pq.ParquetWriter(output_path, schema)
+
+    try:
+        for chunk in _iter_text_chunks(source, text_column, chunk_size):
+            predictions, confidences = batch_predict(chunk, model, tokenizer, **batch_kwargs)[:2]
+
+            if writer is not None:
+                writer.write_table(pa.table({'prediction': predictions,
+                                             'confidence': confidences}, schema=schema))
+
+            yield predictions, confidences
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+class TeacherLogits:
+    """Teacher logits for a training set, indexed by example position.
+
+    Holds either full logits (``logits``, shape ``(N, num_classes)``) or
+    the teacher's top-k (``values`` and class ``indices``, shape
+    ``(N, k)``), stored as float16. Arrays are usually memory-mapped from
+    a directory written by ``precompute_teacher_logits``.
+    """
+
+    def __init__(self, num_classes: int, logits: np.ndarray = None,
+                 values: np.ndarray = None, indices: np.ndarray = None):
+        self.num_classes = num_classes
+        self.logits = logits
+        self.values = values
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.logits if self.logits is not None else self.values)
+
+    @property
+    def top_k(self) -> int:
+        return None if self.values is None else self.values.shape[1]
+
+    def get(self, indices, fill_value: float = float('-inf')) -> torch.Tensor:
+        """Return float32 logits of shape ``(len(indices), num_classes)``.
+
+        With top-k storage, classes outside the teacher's top-k are set to
+        ``fill_value``; the default ``-inf`` gives them zero probability,
+        so soft targets are the teacher's distribution renormalized over
+        its top-k.
+        """
+        indices = np.asarray(indices)
+        if self.logits is not None:
+            return torch.from_numpy(self.logits[indices].astype(np.float32))
+        dense = torch.full((len(indices), self.num_classes), fill_value, dtype=torch.float32)
+        dense.scatter_(1, torch.from_numpy(self.indices[indices].astype(np.int64)),
+                       torch.from_numpy(self.values[indices].astype(np.float32)))
+        return dense
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'TeacherLogits':
+        """Load a directory written by ``precompute_teacher_logits``."""
+        mode = 'r' if mmap else None
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['top_k'] is None:
+            return cls(meta['num_classes'],
+                       logits=np.load(os.path.join(path, 'logits.npy'), mmap_mode=mode))
+        return cls(meta['num_classes'],
+                   values=np.load(os.path.join(path, 'values.npy'), mmap_mode=mode),
+                   indices=np.load(os.path.join(path, 'indices.npy'), mmap_mode=mode))
+
+
+# meta.json first: it is removed before, and written after, the arrays
+_TEACHER_STORE_FILES = ('meta.json', 'logits.npy', 'values.npy', 'indices.npy')
+
+
+def precompute_teacher_logits(texts: Union[List[str], TokenizedTexts], teacher, tokenizer,
+                              output_dir: str, top_k: int = None, batch_size: int = 32,
+                              max_tokens_per_batch: int = None, max_length: int = 512,
+                              device='cpu', prefetch: int = 0) -> TeacherLogits:
+    """Run a distillation teacher over a training set once and store its logits.
+
+    Uses the same length-sorted batching as ``batch_predict``, then writes
+    float16 logits (or just the top ``top_k`` per example, with their class
+    indices) straight into ``.npy`` memmaps under ``output_dir``, so the
+    set never has to fit in memory. The directory also records the
+    teacher's fingerprint and a hash of the inputs; calling again with the
+    same teacher, data and ``top_k`` loads the existing store instead of
+    running the teacher.
+    """
+    if isinstance(texts, TokenizedTexts):
+        encodings = texts
+    else:
+        encodings = TokenizedTexts.from_encodings(
+            tokenizer(texts, truncation=True, max_length=max_length)
+        )
+    if len(encodings) == 0:
+        raise ValueError("No texts to run the teacher on")
+
+    content_hash = hashlib.sha256(np.ascontiguousarray(encodings.offsets).tobytes())
+    for key in sorted(encodings.arrays):
+        content_hash.update(np.ascontiguousarray(encodings.arrays[key]).tobytes())
+    meta = {
+        'teacher': _model_fingerprint(teacher),
+        'data': content_hash.hexdigest(),
+        'num_examples': len(encodings),
+        'top_k': top_k,
+    }
+    meta_path = os.path.join(output_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            existing = json.load(f)
+        if all(existing.get(key) == value for key, value in meta.items()):
+            return TeacherLogits.load(output_dir)
+    elif os.path.isdir(output_dir) and os.listdir(output_dir):
+        raise ValueError(f"{output_dir} is not empty and holds no teacher-logit store; "
+                         f"refusing to write into it")
+
+    prepared_batches = _prepared_batches(encodings, tokenizer, batch_size, device, True,
+                                         max_tokens_per_batch, prefetch, None,
+                                         'precompute_teacher_logits')
+
+    # Write to a scratch directory first so readers never see a partial store
+    tmp_path = f"{os.path.abspath(output_dir)}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    arrays = {}
+    teacher.eval()
+    with torch.inference_mode():
+        for batch_indices, inputs in prepared_batches:
+            logits = teacher(**inputs).logits.float()
+            if not arrays:
+                num_classes = logits.shape[-1]
+                if top_k is None:
+                    shapes = {'logits': ((len(encodings), num_classes), np.float16)}
+                else:
+                    k = min(top_k, num_classes)
+                    index_dtype = np.int16 if num_classes <= np.iinfo(np.int16).max else np.int32
+                    shapes = {'values': ((len(encodings), k), np.float16),
+                              'indices': ((len(encodings), k), index_dtype)}
+                for name, (shape, dtype) in shapes.items():
+                    arrays[name] = np.lib.format.open_memmap(
+                        os.path.join(tmp_path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+
+            if top_k is None:
+                arrays['logits'][batch_indices] = logits.cpu().numpy()
+            else:
+                values, indices = logits.topk(arrays['values'].shape[1], dim=-1)
+                arrays['values'][batch_indices] = values.cpu().numpy()
+                arrays['indices'][batch_indices] = indices.cpu().numpy()
+
+    for memmap in arrays.values():
+        memmap.flush()
+    del arrays
+    meta['num_classes'] = num_classes
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if not os.path.isdir(output_dir):
+        os.replace(tmp_path, output_dir)
+        return TeacherLogits.load(output_dir)
+
+    # Replace only a previous store's own files; meta.json goes last so a
+    # crash midway leaves no store that looks complete
+    for name in _TEACHER_STORE_FILES:
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+    for name in _TEACHER_STORE_FILES[::-1]:
+        path = os.path.join(tmp_path, name)
+        if os.path.exists(path):
+            os.replace(path, os.path.join(output_dir, name))
+    os.rmdir(tmp_path)
+    return TeacherLogits.load(output_dir)
+
+
+def iter_distillation_batches(inputs: TokenizedTexts, teacher_logits: TeacherLogits,
+                              labels=None, batch_size: int = 16, shuffle: bool = True,
+                              seed: int = 0, max_tokens_per_batch: int = None,
+                              pad_token_id: int = 0, padding_side: str = 'right',
+                              prefetch: int = 0) -> Iterator[Dict[str, torch.Tensor]]:
+    """Yield padded student batches together with their stored teacher logits.
+
+    ``inputs`` is the training set tokenized for the student (e.g. with
+    ``pretokenize``); example ``i`` lines up with row ``i`` of
+    ``teacher_logits`` and ``labels``. Each batch is a dict of model inputs
+    plus ``teacher_logits`` and, if given, ``labels``, ready for a
+    ``DistillationLoss``. Pass a different ``seed`` per epoch to reshuffle.
+    With ``prefetch > 0`` padding and the logit reads run on a background
+    thread ahead of the training step.
+    """
+    if len(inputs) != len(teacher_logits):
+        raise ValueError(f"Got {len(inputs)} inputs but {len(teacher_logits)} teacher logits")
+    if labels is not None:
+        labels = np.asarray(labels)
+
+    if shuffle:
+        order = np.random.default_rng(seed).permutation(len(inputs))
+    else:
+        order = np.arange(len(inputs))
+    batches = _plan_batches(order, batch_size, inputs.lengths, max_tokens_per_batch)
+
+    def prepare(batch_indices):
+        batch = inputs.pad(batch_indices, pad_token_id, padding_side)
+        batch['teacher_logits'] = teacher_logits.get(batch_indices)
+        if labels is not None:
+            batch['labels'] = torch.from_numpy(labels[batch_indices].astype(np.int64))
+        return batch
+
+    if prefetch > 0:
+        yield from _prefetched(prepare, batches, prefetch)
+    else:
+        yield from map(prepare, batches)
+
+
+class OnnxModel:
+    """ONNX Runtime session that can stand in for a model in the helpers.
+
+    Calling it with tokenizer outputs returns an object with ``.logits``,
+    like a HuggingFace model, so it works with ``predict_with_model`` and
+    ``batch_predict``. Create one with ``load_inference_backend``.
+    """
+
+    def __init__(self, onnx_path: str, config=None, num_threads: int = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.onnx_path = onnx_path
+        self.config = config
+        self.training = False
+
+    def eval(self):
+        return self
+
+    def __call__(self, **inputs):
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        logits = self.session.run(['logits'], feed)[0]
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Wrap a HuggingFace model so ONNX export sees positional tensors in, logits out."""
+
+    def __init__(self, model, input_names: List[str]):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *tensors):
+        return self.model(**dict(zip(self.input_names, tensors))).logits
+
+
+def _model_fingerprint(model) -> str:
+    """Identity for a model's architecture and exact weights, for cache keys.
+
+    Hashes every tensor's bytes, so it costs one pass over the weights.
+    """
+    config = getattr(model, 'config', None)
+    digest = hashlib.sha256(model.__class__.__name__.encode('utf-8'))
+    digest.update((config.to_json_string() if config is not None else '').encode('utf-8'))
+
+    def update(name, value):
+        if isinstance(value, (tuple, list)):
+            # Dynamically quantized layers store packed (weight, bias) tuples
+            for i, item in enumerate(value):
+                update(f"{name}.{i}", item)
+        elif isinstance(value, torch.Tensor):
+            if value.is_quantized:
+                value = value.int_repr()
+            value = value.detach().cpu().contiguous()
+            digest.update(f"{name}:{tuple(value.shape)}:{value.dtype}".encode('utf-8'))
+            digest.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            digest.update(f"{name}:{value}".encode('utf-8'))
+
+    with torch.no_grad():
+        for name, value in model.state_dict().items():
+            update(name, value)
+    return digest.hexdigest()
+
+
+def export_onnx(model, tokenizer, path: str, opset_version: int = 17):
+    """Export a sequence-classification model to ONNX with dynamic batch/sequence axes."""
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids')
+                   if name in sample]
+    export_kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        export_kwargs['dynamo'] = False  # classic exporter, no onnxscript needed
+    was_training = model.training
+    model.eval()
+    try:
+        torch.onnx.export(
+            _LogitsOnly(model, input_names),
+            tuple(sample[name] for name in input_names),
+            path,
+            input_names=input_names,
+            output_names=['logits'],
+            dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names},
+                          'logits': {0: 'batch'}},
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+    finally:
+        model.train(was_training)
+
+
+def load_inference_backend(model, backend: str = 'pytorch', tokenizer=None,
+                           cache_dir: str = '.onnx_cache', num_threads: int = None):
+    """Return a model-like object running on the chosen inference backend.
+
+    - ``'pytorch'``: the eager fp32 model itself.
+    - ``'int8'``: a dynamically quantized copy (int8 ``nn.Linear`` weights).
+    - ``'onnx'``: an ONNX Runtime CPU session. The export runs once per
+      model and is cached in ``cache_dir``, keyed by a fingerprint of the
+      config and weights. Requires ``tokenizer``, ``onnx`` and
+      ``onnxruntime``.
+
+    Pass the result to ``predict_with_model``/``batch_predict`` in place of
+    the model, and check it with ``check_backend_parity`` first.
+    """
+    if backend == 'pytorch':
+        return model
+    if backend == 'int8':
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == 'onnx':
+        if tokenizer is None:
+            raise ValueError("The onnx backend needs the tokenizer to trace the export")
+        os.makedirs(cache_dir, exist_ok=True)
+        onnx_path = os.path.join(cache_dir, f"{_model_fingerprint(model)}.onnx")
+        if not os.path.exists(onnx_path):
+            tmp_path = f"{onnx_path}.tmp{os.getpid()}"
+            export_onnx(model, tokenizer, tmp_path)
+            os.replace(tmp_path, onnx_path)
+        return OnnxModel(onnx_path, getattr(model, 'config', None), num_threads)
+    raise ValueError(f"Unknown backend: {backend} (expected pytorch, int8 or onnx)")
+
+
+def check_backend_parity(reference_model, backend_model, tokenizer, texts: List[str],
+                         batch_size: int = 16) -> Dict:
+    """Compare a backend's predictions against the fp32 reference model.
+
+    Returns the fraction of texts with the same predicted label and the
+    mean/max absolute difference in confidence.
+    """
+    ref_predictions, ref_confidences = batch_predict(texts, reference_model, tokenizer,
+                                                     batch_size=batch_size)
+    predictions, confidences = batch_predict(texts, backend_model, tokenizer,
+                                             batch_size=batch_size)
+    confidence_diff = np.abs(ref_confidences - confidences)
+    return {
+        'label_agreement': float((ref_predictions == predictions).mean()) if len(texts) else 1.0,
+        'mean_confidence_diff': float(confidence_diff.mean()) if len(texts) else 0.0,
+        'max_confidence_diff': float(confidence_diff.max()) if len(texts) else 0.0,
+    }
+
+
+class AdapterManager:
+    """Serve many LoRA adapters from one frozen base model.
+
+    Adapters are registered by id with the directory ``save_pretrained``
+    wrote them to, and loaded into a single PEFT model the first time they
+    are requested. At most ``max_loaded`` stay resident; the least recently
+    used one is unloaded to make room. Requests are routed with
+    ``predict_with_model`` / ``batch_predict``; a mixed batch is grouped by
+    adapter so each group is one ``batch_predict`` call.
+
+    With ``merge_hottest=True`` the adapter with the most requests among
+    the last ``hot_window`` is merged into the base weights while it is
+    served, removing the LoRA matmuls from its forward pass. It is unmerged
+    before any other adapter runs. Merging into a 4-bit (QLoRA) base is
+    lossy, so leave it off there. Calls are serialized with a lock since
+    switching adapters changes shared model state.
+    """
+
+    def __init__(self, base_model, tokenizer, adapters: Dict[str, str] = None,
+                 max_loaded: int = 8, merge_hottest: bool = False, hot_window: int = 1000):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be at least 1")
+        for param in base_model.parameters():
+            param.requires_grad_(False)
+        self.base_model = base_model.eval()
+        self.tokenizer = tokenizer
+        self.max_loaded = max_loaded
+        self.merge_hottest = merge_hottest
+        self.model = None
+        self.paths = dict(adapters or {})
+        self._loaded = OrderedDict()  # adapter id -> None, least recently used first
+        self._active = None
+        self._merged = None
+        self._recent = deque(maxlen=hot_window)
+        self._recent_counts = {}
+        self._lock = threading.RLock()
+        self.loads = 0
+        self.evictions = 0
+        self.switches = 0
+
+    def register(self, adapter_id: str, path: str):
+        """Make an adapter available under ``adapter_id``; it is loaded on first use."""
+        self.paths[adapter_id] = path
+
+    def _require_registered(self, adapter_ids: Iterable[str]):
+        unknown = [adapter_id for adapter_id in adapter_ids if adapter_id not in self.paths]
+        if unknown:
+            raise KeyError(f"Unknown adapter(s): {unknown}")
+
+    def _count_requests(self, adapter_id: str, count: int):
+        for _ in range(min(count, self._recent.maxlen)):
+            if len(self._recent) == self._recent.maxlen:
+                oldest = self._recent.popleft()
+                self._recent_counts[oldest] -= 1
+            self._recent.append(adapter_id)
+            self._recent_counts[adapter_id] = self._recent_counts.get(adapter_id, 0) + 1
+
+    def hottest(self) -> str:
+        """The adapter with the most requests among the last ``hot_window``."""
+        if not self._recent_counts:
+            return None
+        return max(self._recent_counts, key=self._recent_counts.get)
+
+    def _load(self, adapter_id: str):
+        if self.model is None:
+            from peft import PeftModel
+            self.model = PeftModel.from_pretrained(self.base_model, self.paths[adapter_id],
+                                                   adapter_name=adapter_id, is_trainable=False)
+            self.model.eval()
+        else:
+            self.model.load_adapter(self.paths[adapter_id], adapter_name=adapter_id,
+                                    is_trainable=False)
+        self._loaded[adapter_id] = None
+        self.loads += 1
+
+    def _evict(self):
+        while len(self._loaded) > self.max_loaded:
+            adapter_id = next(iter(self._loaded))
+            if adapter_id == self._merged:
+                self.model.unmerge_adapter()
+                self._merged = None
+            self.model.delete_adapter(adapter_id)
+            del self._loaded[adapter_id]
+            self.evictions += 1
+
+    def _activate(self, adapter_id: str):
+        """Load (if needed) and switch to ``adapter_id``, merging it if it is the hottest."""
+        if adapter_id in self._loaded:
+            self._loaded.move_to_end(adapter_id)
+        else:
+            self._load(adapter_id)
+
+        if self._merged is not None and self._merged != adapter_id:
+            # A merged adapter lives in the base weights and would leak into other adapters
+            self.model.unmerge_adapter()
+            self._merged = None
+        if adapter_id != self._active:
+            self.model.set_adapter(adapter_id)
+            self._active = adapter_id
+            self.switches += 1
+        if self.merge_hottest and self._merged is None and adapter_id == self.hottest():
+            self.model.merge_adapter()
+            self._merged = adapter_id
+
+        self._evict()
+
+    def predict_with_model(self, text: str, adapter_id: str, device='cpu',
+                           cache: PredictionCache = None):
+        """``predict_with_model`` for one text using ``adapter_id``."""
+        self._require_registered([adapter_id])
+        with self._lock:
+            self._count_requests(adapter_id, 1)
+            self._activate(adapter_id)
+            return predict_with_model(text, self.model, self.tokenizer, device=device, cache=cache)
+
+    def batch_predict(self, texts: List[str], adapter_ids: Union[str, List[str]],
+                      **batch_kwargs):
+        """``batch_predict`` with each text routed to its adapter.
+
+        ``adapter_ids`` is one id for the whole batch or one per text.
+        Texts are grouped by adapter, the currently active adapter's group
+        first to save a switch, and results are returned in input order in
+        the same shape as ``batch_predict``.
+        """
+        if isinstance(adapter_ids, str):
+            adapter_ids = [adapter_ids] * len(texts)
+        if len(adapter_ids) != len(texts):
+            raise ValueError(f"Got {len(texts)} texts but {len(adapter_ids)} adapter ids")
+
+        groups = {}
+        for i, adapter_id in enumerate(adapter_ids):
+            groups.setdefault(adapter_id, []).append(i)
+        # Validate before counting so unknown ids can't become the hottest adapter
+        self._require_registered(groups)
+        order = sorted(groups, key=lambda adapter_id: adapter_id != self._active)
+
+        top_k = batch_kwargs.get('top_k', 1)
+        result_shape = (len(texts),) if top_k == 1 else (len(texts), top_k)
+        all_predictions = np.empty(result_shape, dtype=np.int64)
+        all_confidences = np.empty(result_shape, dtype=np.float32)
+        batch_stats = []
+
+        with self._lock:
+            for adapter_id, indices in groups.items():
+                self._count_requests(adapter_id, len(indices))
+            for adapter_id in order:
+                indices = np.array(groups[adapter_id])
+                self._activate(adapter_id)
+                result = batch_predict([texts[i] for i in indices], self.model, self.tokenizer,
+                                       **batch_kwargs)
+                all_predictions[indices] = result[0]
+                all_confidences[indices] = result[1]
+                if len(result) > 2:
+                    batch_stats.extend(result[2])
+
+        if batch_kwargs.get('return_stats'):
+            return all_predictions, all_confidences, batch_stats
+        return all_predictions, all_confidences
+
+    def stats(self) -> Dict:
+        return {
+            'loaded': list(self._loaded),
+            'active': self._active,
+            'merged': self._merged,
+            'hottest': self.hottest(),
+            'registered': len(self.paths),
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'switches': self.switches,
+        }
+
+
+_ISA_FLAGS = ('sse4_2', 'avx', 'avx2', 'fma', 'avx512f', 'avx512_vnni', 'avx512_bf16',
+              'avx512_fp16', 'avx_vnni', 'amx_tile', 'amx_bf16', 'amx_int8')
+
+
+def _read_text(path: str) -> str:
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def _available_memory_bytes() -> int:
+    """Memory available to new allocations, from /proc/meminfo (or psutil)."""
+    for line in _read_text('/proc/meminfo').splitlines():
+        if line.startswith('MemAvailable:'):
+            return int(line.split()[1]) * 1024
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return None
+
+
+def _current_rss_bytes() -> int:
+    """Current (not peak) resident set size of this process, Linux only."""
+    statm = _read_text('/proc/self/statm').split()
+    return int(statm[1]) * os.sysconf('SC_PAGE_SIZE') if len(statm) > 1 else None
+
+
+@contextmanager
+def _sampled_peak_rss(interval: float = 0.001):
+    """Track this process's peak RSS while the block runs, without touching global state.
+
+    A background thread samples the current RSS every ``interval`` seconds,
+    so spikes shorter than that can be missed. Yields a dict whose
+    ``peak`` (bytes, None off Linux) is final once the block exits.
+    """
+    result = {'peak': _current_rss_bytes()}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            rss = _current_rss_bytes()
+            if rss is not None and rss > result['peak']:
+                result['peak'] = rss
+
+    if result['peak'] is None:
+        yield result
+        return
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        sampler.join()
+        rss = _current_rss_bytes()
+        if rss is not None and rss > result['peak']:
+            result['peak'] = rss
+
+
+def probe_hardware() -> Dict:
+    """Collect CPU, memory, ISA and torch threading facts for the current host.
+
+    Linux details (physical cores, NUMA nodes, ISA flags) come from
+    ``/proc`` and ``/sys``; fields that cannot be determined are None.
+    """
+    cpuinfo = _read_text('/proc/cpuinfo')
+    cores, flags = set(), set()
+    model_name = platform.processor() or platform.machine()
+    physical_id = None
+    for line in cpuinfo.splitlines():
+        key, _, value = (part.strip() for part in line.partition(':'))
+        if key == 'physical id':
+            physical_id = value
+        elif key == 'core id':
+            cores.add((physical_id, value))
+        elif key == 'flags' and not flags:
+            flags = set(value.split())
+        elif key == 'model name':
+            model_name = value
+    numa_nodes = None
+    if os.path.isdir('/sys/devices/system/node'):
+        numa_nodes = len([d for d in os.listdir('/sys/devices/system/node')
+                          if d.startswith('node') and d[4:].isdigit()])
+    total_memory = None
+    for line in _read_text('/proc/meminfo').splitlines():
+        if line.startswith('MemTotal:'):
+            total_memory = int(line.split()[1]) * 1024
+
+    usable_cpus = (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+                   else os.cpu_count())
+    cpu_capability = None
+    if hasattr(torch.backends, 'cpu') and hasattr(torch.backends.cpu, 'get_cpu_capability'):
+        cpu_capability = torch.backends.cpu.get_cpu_capability()
+
+    report = {
+        'cpu_model': model_name,
+        'logical_cpus': os.cpu_count(),
+        'usable_cpus': usable_cpus,
+        'physical_cores': len(cores) or None,
+        'numa_nodes': numa_nodes,
+        'total_memory_gb': total_memory / 1024 ** 3 if total_memory else None,
+        'available_memory_gb': (_available_memory_bytes() or 0) / 1024 ** 3 or None,
+        'isa': {flag: flag in flags for flag in _ISA_FLAGS} if flags else None,
+        'torch_cpu_capability': cpu_capability,
+        'torch_num_threads': torch.get_num_threads(),
+        'torch_num_interop_threads': torch.get_num_interop_threads(),
+        'mkldnn_available': torch.backends.mkldnn.is_available(),
+        'openmp_available': torch.backends.openmp.is_available(),
+        'cuda_available': torch.cuda.is_available(),
+        'cuda_devices': [torch.cuda.get_device_name(i) for i in range(torch.cuda.device_count())],
+    }
+    return report
+
+
 def check_gpu_availability():
-    """Check and print GPU availability information."""
+    """Check and print GPU availability information.
+
+    Also prints the CPU side of ``probe_hardware()`` and returns its dict.
+    """
+    hardware = probe_hardware()
+
     print("=" * 60)
     print("HARDWARE INFORMATION")
     print("=" * 60)
@@ -209,12 +2181,181 @@ def check_gpu_availability():
         print("⚠️  CUDA is not available. Using CPU.")
         print("Training will be slower. Consider using Google Colab for free GPU access.")
 
+    print(f"\nCPU: {hardware['cpu_model']}")
+    print(f"Cores: {hardware['physical_cores'] or '?'} physical, "
+          f"{hardware['usable_cpus']} usable of {hardware['logical_cpus']} logical, "
+          f"{hardware['numa_nodes'] or '?'} NUMA node(s)")
+    if hardware['available_memory_gb'] is not None:
+        print(f"RAM: {hardware['available_memory_gb']:.2f} GB available"
+              f" of {hardware['total_memory_gb']:.2f} GB")
+    if hardware['isa']:
+        supported = [flag for flag, present in hardware['isa'].items() if present]
+        print(f"ISA: {', '.join(supported) or 'baseline only'}")
+    print(f"Torch threads: {hardware['torch_num_threads']} intra-op, "
+          f"{hardware['torch_num_interop_threads']} inter-op "
+          f"(CPU capability: {hardware['torch_cpu_capability']})")
+
     print("=" * 60)
+    return hardware
+
+
+def _run_isolated(fn, timeout: float = 600):
+    """Run ``fn`` in a forked child so an OOM kill cannot take down the caller.
+
+    Returns ``('ok', result)``, ``('error', message)`` or ``('killed', exitcode)``.
+    Without fork the function runs in-process and only exceptions are caught.
+    """
+    if 'fork' not in mp.get_all_start_methods():
+        try:
+            return 'ok', fn()
+        except (RuntimeError, MemoryError) as e:
+            return 'error', repr(e)
+
+    ctx = mp.get_context('fork')
+    reader, writer = ctx.Pipe(duplex=False)
+
+    def target():
+        try:
+            writer.send(('ok', fn()))
+        except BaseException as e:
+            writer.send(('error', repr(e)))
+
+    process = ctx.Process(target=target)
+    process.start()
+    writer.close()
+    try:
+        result = reader.recv() if reader.poll(timeout) else ('killed', 'timeout')
+    except EOFError:
+        result = None
+    process.join(timeout=5)
+    if process.is_alive():
+        process.kill()
+        process.join()
+    return result if result is not None else ('killed', process.exitcode)
+
+
+def autotune_batch_size(model, tokenizer, sample_texts: List[str] = None, seq_len: int = 128,
+                        max_batch_size: int = 1024, memory_fraction: float = 0.8,
+                        latency_budget_ms: float = None,
+                        thread_counts: List[int] = None) -> Dict:
+    """Find the largest safe CPU batch size for ``model`` on this box and tune threads.
+
+    Each trial runs one forward pass on a batch padded to ``seq_len`` in a
+    forked child, recording latency and peak memory growth. CPU only: a
+    forked child can't re-initialize CUDA, so a model on a GPU raises
+    ``ValueError``. A batch size
+    is safe if it runs, stays under ``memory_fraction`` of available RAM
+    and, if given, within ``latency_budget_ms``. Batch sizes are doubled
+    until one fails and then binary-searched.
+
+    Returns ``max_safe_batch_size``, ``recommended_batch_size`` (the
+    smallest batch within 5% of the best throughput seen),
+    ``max_tokens_per_batch`` for ``batch_predict``, the measured trials,
+    and ``recommended_threads`` from timing ``thread_counts``.
+    """
+    if any(param.device.type != 'cpu' for param in model.parameters()):
+        raise ValueError("autotune_batch_size only tunes CPU inference; move the model to CPU")
+    sample_texts = sample_texts or ["The quick brown fox jumps over the lazy dog."]
+    memory_limit = (_available_memory_bytes() or float('inf')) * memory_fraction
+    model.eval()
+
+    def make_inputs(batch_size):
+        texts = [sample_texts[i % len(sample_texts)] for i in range(batch_size)]
+        return tokenizer(texts, return_tensors="pt", truncation=True,
+                         padding='max_length', max_length=seq_len)
+
+    def trial(batch_size):
+        def measure():
+            inputs = make_inputs(batch_size)
+            before = _current_rss_bytes() or 0
+            with torch.inference_mode():
+                model(**inputs)
+                start = time.perf_counter()
+                model(**inputs)
+                elapsed = time.perf_counter() - start
+            peak = _peak_memory_mb('cpu')
+            growth = peak * 1024 ** 2 - before if peak is not None else 0
+            return elapsed, max(growth, 0)
+
+        status, value = _run_isolated(measure)
+        record = {'batch_size': batch_size, 'status': status}
+        if status == 'ok':
+            elapsed, growth = value
+            record.update(latency_ms=elapsed * 1000, memory_mb=growth / 1024 ** 2,
+                          throughput=batch_size / elapsed)
+            if growth > memory_limit:
+                record['status'] = 'over_memory'
+            elif latency_budget_ms is not None and elapsed * 1000 > latency_budget_ms:
+                record['status'] = 'over_latency'
+        else:
+            record['detail'] = str(value)
+        trials.append(record)
+        return record['status'] == 'ok'
+
+    trials = []
+    good, bad = 0, None
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        if not trial(batch_size):
+            bad = batch_size
+            break
+        good = batch_size
+        batch_size *= 2
+    if bad is None:
+        bad = max_batch_size + 1 if good < max_batch_size else None
+    while bad is not None and bad - good > 1:
+        middle = (good + bad) // 2
+        if trial(middle):
+            good = middle
+        else:
+            bad = middle
+
+    ok_trials = [t for t in trials if t['status'] == 'ok']
+    recommended = good
+    if ok_trials:
+        best = max(t['throughput'] for t in ok_trials)
+        recommended = min(t['batch_size'] for t in ok_trials if t['throughput'] >= 0.95 * best)
+
+    # Time the recommended batch at a few thread counts
+    usable = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if thread_counts is None:
+        thread_counts = sorted({1, 2, 4, 8, 16, 32, usable} & set(range(1, usable + 1)))
+    thread_results = {}
+    original_threads = torch.get_num_threads()
+    if recommended:
+        inputs = make_inputs(recommended)
+        try:
+            for threads in thread_counts:
+                torch.set_num_threads(threads)
+                with torch.inference_mode():
+                    model(**inputs)
+                    start = time.perf_counter()
+                    model(**inputs)
+                    thread_results[threads] = recommended / (time.perf_counter() - start)
+        finally:
+            torch.set_num_threads(original_threads)
+    recommended_threads = max(thread_results, key=thread_results.get) if thread_results else None
+
+    return {
+        'seq_len': seq_len,
+        'max_safe_batch_size': good,
+        'recommended_batch_size': recommended,
+        'max_tokens_per_batch': good * seq_len,
+        'recommended_threads': recommended_threads,
+        'throughput_by_threads': thread_results,
+        'memory_limit_mb': memory_limit / 1024 ** 2 if memory_limit != float('inf') else None,
+        'trials': trials,
+    }
 
 
 def estimate_training_time(num_samples: int, batch_size: int, num_epochs: int,
                           samples_per_second: float = 10):
-    """Estimate training time."""
+    """Estimate training time.
+
+    ``samples_per_second`` is a guess unless you pass a measured value,
+    e.g. ``profile_training(...)['samples_per_second']``; use
+    ``profile_training`` with ``num_samples`` for a full estimate.
+    """
     steps_per_epoch = num_samples // batch_size
     total_steps = steps_per_epoch * num_epochs
     estimated_seconds = total_steps * (batch_size / samples_per_second)
@@ -226,6 +2367,339 @@ def estimate_training_time(num_samples: int, batch_size: int, num_epochs: int,
     print(f"(This is a rough estimate. Actual time may vary)")
 
 
+def _config_value(config, name: str, default):
+    """Read a setting from a ``TrainingArguments`` object or a plain dict."""
+    if config is None:
+        return default
+    if isinstance(config, dict):
+        return config.get(name, default)
+    return getattr(config, name, default)
+
+
+def _peak_memory_mb(device) -> float:
+    """Peak memory so far: allocated CUDA memory, or process RSS on CPU."""
+    if str(device).startswith('cuda'):
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def profile_training(model, tokenizer, sample_texts: List[str], training_args=None,
+                     num_samples: int = None, max_length: int = 128,
+                     padding='max_length', num_steps: int = 5, warmup_steps: int = 1,
+                     device='cpu') -> Dict:
+    """Measure real training throughput and extrapolate a full run.
+
+    Runs ``warmup_steps + num_steps`` forward/backward passes and AdamW
+    steps on batches drawn from ``sample_texts`` (with random labels),
+    then restores the model's weights. Batch size, epochs, gradient
+    accumulation, ``max_steps`` and learning rate are read from
+    ``training_args`` (a ``TrainingArguments`` or a dict with the same
+    field names). ``padding`` is passed to the tokenizer and defaults to
+    padding to ``max_length``, as the lessons do.
+
+    Returns measured ``samples_per_second``, ``tokens_per_second`` (real,
+    non-pad tokens), ``padded_tokens_per_second``, per-step timings and
+    ``peak_memory_mb``: how far memory rose above what was resident just
+    before the profiled steps (weights, inputs and the snapshot used to
+    restore them), i.e. activations, gradients and optimizer state at
+    their peak. On CPU it is the process RSS sampled every millisecond
+    during the steps (Linux only, None elsewhere; very brief spikes can be
+    missed), which leaves the process's lifetime peak RSS untouched. On
+    GPU it is allocated CUDA memory, and the device's CUDA peak-memory
+    statistics are reset as a side effect. With ``num_samples`` it also returns
+    ``steps_per_epoch``, ``total_optimizer_steps`` and
+    ``estimated_seconds`` for the whole run.
+    """
+    batch_size = _config_value(training_args, 'per_device_train_batch_size', 8)
+    num_epochs = _config_value(training_args, 'num_train_epochs', 3)
+    accumulation = _config_value(training_args, 'gradient_accumulation_steps', 1)
+    max_steps = _config_value(training_args, 'max_steps', -1)
+    learning_rate = _config_value(training_args, 'learning_rate', 5e-5)
+
+    num_labels = getattr(getattr(model, 'config', None), 'num_labels', 2)
+    texts = [sample_texts[i % len(sample_texts)] for i in range(batch_size)]
+    inputs = tokenizer(texts, return_tensors="pt", truncation=True,
+                       padding=padding, max_length=max_length).to(device)
+    labels = torch.randint(0, num_labels, (batch_size,), device=device)
+
+    saved_state = {k: v.detach().clone() for k, v in model.state_dict().items()}
+    was_training = model.training
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=learning_rate
+    )
+    # Baseline after the weight snapshot, so only the training steps are counted
+    on_cuda = str(device).startswith('cuda')
+    if on_cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+        memory_before = torch.cuda.memory_allocated(device)
+    else:
+        memory_before = _current_rss_bytes()
+
+    def sync():
+        if str(device).startswith('cuda'):
+            torch.cuda.synchronize(device)
+
+    backward_times, optimizer_times = [], []
+    model.train()
+    try:
+        with nullcontext() if on_cuda else _sampled_peak_rss() as rss:
+            for step in range(warmup_steps + num_steps):
+                sync()
+                start = time.perf_counter()
+                loss = model(**inputs, labels=labels).loss
+                loss.backward()
+                sync()
+                middle = time.perf_counter()
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+                sync()
+                end = time.perf_counter()
+                if step >= warmup_steps:
+                    backward_times.append(middle - start)
+                    optimizer_times.append(end - middle)
+        if on_cuda:
+            memory_after = torch.cuda.max_memory_allocated(device)
+        else:
+            memory_after = rss['peak']
+    finally:
+        model.load_state_dict(saved_state)
+        model.train(was_training)
+        del optimizer
+    peak_memory_mb = None
+    if memory_before is not None and memory_after is not None:
+        peak_memory_mb = max(memory_after - memory_before, 0) / 1024 ** 2
+
+    forward_backward_seconds = float(np.median(backward_times))
+    optimizer_seconds = float(np.median(optimizer_times))
+    # With accumulation the optimizer only runs once every ``accumulation`` batches
+    seconds_per_batch = forward_backward_seconds + optimizer_seconds / accumulation
+    real_tokens = int(inputs['attention_mask'].sum().item()) if 'attention_mask' in inputs \
+        else inputs['input_ids'].numel()
+
+    report = {
+        'batch_size': batch_size,
+        'sequence_length': inputs['input_ids'].shape[1],
+        'gradient_accumulation_steps': accumulation,
+        'forward_backward_seconds': forward_backward_seconds,
+        'optimizer_step_seconds': optimizer_seconds,
+        'samples_per_second': batch_size / seconds_per_batch,
+        'tokens_per_second': real_tokens / seconds_per_batch,
+        'padded_tokens_per_second': inputs['input_ids'].numel() / seconds_per_batch,
+        'peak_memory_mb': peak_memory_mb,
+    }
+
+    if num_samples is not None:
+        batches_per_epoch = -(-num_samples // batch_size)
+        steps_per_epoch = max(batches_per_epoch // accumulation, 1)
+        if max_steps is not None and max_steps > 0:
+            total_steps = max_steps
+        else:
+            total_steps = int(steps_per_epoch * num_epochs)
+        report.update({
+            'num_samples': num_samples,
+            'steps_per_epoch': steps_per_epoch,
+            'total_optimizer_steps': total_steps,
+            'estimated_seconds': total_steps * accumulation * seconds_per_batch,
+        })
+
+    return report
+
+
+def _pack_lengths(lengths: List[int], max_length: int) -> List[List[int]]:
+    """Group example indices into rows of at most ``max_length`` tokens.
+
+    First-fit decreasing: longest examples are placed first, each into the
+    first row with room for it.
+    """
+    rows, room = [], []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for r, free in enumerate(room):
+            if lengths[idx] <= free:
+                rows[r].append(idx)
+                room[r] -= lengths[idx]
+                break
+        else:
+            rows.append([idx])
+            room.append(max_length - lengths[idx])
+    return rows
+
+
+class PackingCollator:
+    """Data collator that packs several tokenized examples into each row.
+
+    Takes unpadded features (``input_ids`` plus ``label``/``labels``, e.g.
+    from a ``tokenize_function`` with ``truncation=True`` and no padding)
+    and packs them into rows of at most ``max_length`` tokens instead of
+    padding each example to ``max_length``. Each batch carries a 4D
+    block-diagonal boolean ``attention_mask`` so examples only attend to
+    themselves, ``position_ids`` that restart at 0 for every example
+    (shifted by ``packed_classification`` where a model counts from a
+    different origin), and
+    ``packed_cls_index``, the flat position of each example's first token.
+    Labels stay one per example, in feature order.
+
+    Classification models need ``packed_classification(model)`` active to
+    pool each example's first token rather than each row's. Attention cost
+    grows with the square of the row length, so moderate ``max_length``
+    values (128-256) work best for short texts.
+    """
+
+    def __init__(self, max_length: int = 256, pad_token_id: int = 0,
+                 pad_to_multiple_of: int = None):
+        self.max_length = max_length
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.examples = 0
+        self.rows = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features: List[Dict]) -> Dict[str, torch.Tensor]:
+        ids = [list(feature['input_ids'])[:self.max_length] for feature in features]
+        lengths = [len(example) for example in ids]
+        rows = _pack_lengths(lengths, self.max_length)
+        width = max(sum(lengths[i] for i in row) for row in rows)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        input_ids = np.full((len(rows), width), self.pad_token_id, dtype=np.int64)
+        position_ids = np.zeros((len(rows), width), dtype=np.int64)
+        segments = np.full((len(rows), width), -1, dtype=np.int64)  # padding is its own segment
+        cls_index = np.empty(len(features), dtype=np.int64)
+        for r, row in enumerate(rows):
+            col = 0
+            for segment, idx in enumerate(row):
+                end = col + lengths[idx]
+                input_ids[r, col:end] = ids[idx]
+                position_ids[r, col:end] = np.arange(lengths[idx])
+                segments[r, col:end] = segment
+                cls_index[idx] = r * width + col
+                col = end
+
+        self.examples += len(features)
+        self.rows += len(rows)
+        self.real_tokens += sum(lengths)
+        self.padded_tokens += input_ids.size
+
+        batch = {
+            'input_ids': torch.from_numpy(input_ids),
+            'attention_mask': torch.from_numpy(segments[:, None, :, None] == segments[:, None, None, :]),
+            'position_ids': torch.from_numpy(position_ids),
+            'packed_cls_index': torch.from_numpy(cls_index),
+        }
+        label_key = 'labels' if 'labels' in features[0] else 'label'
+        if label_key in features[0]:
+            batch['labels'] = torch.tensor([feature[label_key] for feature in features])
+        return batch
+
+    def stats(self) -> Dict:
+        """Token utilization of the batches collated so far.
+
+        ``utilization`` is the share of real tokens in the packed batches;
+        ``max_length_utilization`` is what padding every example to
+        ``max_length`` would have given, and ``token_reduction`` is how many
+        times fewer token positions packing processed.
+        """
+        unpacked_tokens = self.examples * self.max_length
+        return {
+            'examples': self.examples,
+            'rows': self.rows,
+            'examples_per_row': self.examples / self.rows if self.rows else 0.0,
+            'real_tokens': self.real_tokens,
+            'padded_tokens': self.padded_tokens,
+            'utilization': self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0,
+            'max_length_utilization': self.real_tokens / unpacked_tokens if unpacked_tokens else 0.0,
+            'token_reduction': unpacked_tokens / self.padded_tokens if self.padded_tokens else 0.0,
+        }
+
+
+def packing_utilization(lengths: List[int], max_length: int = 256,
+                        batch_size: int = 16) -> Dict:
+    """Compare token utilization of padding strategies before training.
+
+    ``lengths`` are tokenized example lengths in training order. Returns
+    the share of real tokens when each batch of ``batch_size`` examples is
+    padded to ``max_length`` (what the lessons do), padded to its longest
+    member, or packed by ``PackingCollator``.
+    """
+    lengths = np.minimum(np.asarray(lengths, dtype=np.int64), max_length)
+    real = int(lengths.sum())
+    dynamic = packed = 0
+    for start in range(0, len(lengths), batch_size):
+        chunk = lengths[start:start + batch_size]
+        dynamic += len(chunk) * int(chunk.max())
+        rows = _pack_lengths(chunk.tolist(), max_length)
+        packed += len(rows) * max(int(chunk[row].sum()) for row in rows)
+    return {
+        'examples': len(lengths),
+        'real_tokens': real,
+        'max_length': real / (len(lengths) * max_length) if len(lengths) else 0.0,
+        'dynamic_padding': real / dynamic if dynamic else 0.0,
+        'packed': real / packed if packed else 0.0,
+    }
+
+
+@contextmanager
+def packed_classification(model):
+    """Let a sequence-classification model train on ``PackingCollator`` batches.
+
+    While active, a ``packed_cls_index`` passed to the model selects each
+    example's first-token state from the encoder output, and the model's
+    own pooler, classification head and loss then run on those states, so
+    logits and ``labels`` are one per example. Batches without
+    ``packed_cls_index`` pass through unchanged.
+
+    Works with absolute-position encoders exposed as ``base_model.encoder``
+    (BERT, RoBERTa family) or ``base_model.transformer`` (DistilBERT).
+    RoBERTa-family embeddings number positions from ``padding_idx + 1``,
+    so the collator's 0-based ``position_ids`` are shifted by that offset.
+    """
+    base = model.base_model
+    encoder = getattr(base, 'encoder', None) or getattr(base, 'transformer', None)
+    embeddings = getattr(base, 'embeddings', None)
+    if encoder is None or embeddings is None:
+        raise ValueError(f"Don't know where the encoder of {model.__class__.__name__} is")
+    if not hasattr(embeddings, 'position_embeddings'):
+        raise ValueError(f"{model.__class__.__name__} has no absolute position embeddings "
+                         f"to restart per packed example")
+    padding_idx = getattr(embeddings, 'padding_idx', None)
+    position_offset = padding_idx + 1 if padding_idx is not None else 0
+    state = {}
+
+    def take_index(module, args, kwargs):
+        state['index'] = kwargs.pop('packed_cls_index', None)
+        if state['index'] is not None and position_offset and kwargs.get('position_ids') is not None:
+            kwargs['position_ids'] = kwargs['position_ids'] + position_offset
+        return args, kwargs
+
+    def select_examples(module, args, output):
+        index = state.get('index')
+        if index is None:
+            return output
+        hidden = output[0]
+        selected = hidden.reshape(-1, hidden.shape[-1])[index.to(hidden.device)].unsqueeze(1)
+        if isinstance(output, tuple):
+            return (selected,) + output[1:]
+        output.last_hidden_state = selected
+        return output
+
+    handles = [model.register_forward_pre_hook(take_index, with_kwargs=True),
+               encoder.register_forward_hook(select_examples)]
+    try:
+        yield model
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
 def save_model_card(model_name: str, task: str, metrics: Dict, save_path: str):
     """Generate a model card README."""
     card = f"""# {model_name}
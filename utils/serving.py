@@ -0,0 +1,205 @@
+"""
+Async micro-batching inference server
+
+Concurrent single-text requests are queued and flushed through
+``batch_predict`` as one batch once ``max_batch_size`` requests are
+waiting or the oldest has waited ``max_wait_ms``, whichever comes first.
+Batching raises throughput under concurrent load while the wait bound
+caps the extra latency any one request pays.
+
+Usage:
+    from utils.serving import create_app
+    app = create_app(model, tokenizer, max_batch_size=32, max_wait_ms=5)
+    # uvicorn.run(app, host="0.0.0.0", port=8000)
+
+Or test in-process without a server:
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        response = await client.post("/predict", json={"text": "Great product!"})
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict, List, Tuple
+
+from utils.helpers import batch_predict, get_metrics_registry, MetricsRegistry
+
+
+class MicroBatcher:
+    """Queue single-text requests and run them through ``batch_predict`` in batches.
+
+    The worker task starts on the first ``predict`` call, so the batcher
+    works under any running event loop. Batches run one at a time on a
+    single executor thread; requests arriving meanwhile form the next
+    batch. Extra keyword arguments are passed on to ``batch_predict``.
+    """
+
+    def __init__(self, model, tokenizer, max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0, **batch_kwargs):
+        if 'batch_size' in batch_kwargs:
+            raise ValueError("batch_size is set per flush; use max_batch_size to bound it")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batch_kwargs = batch_kwargs
+        self._queue = None
+        self._worker = None
+        self._executor = None
+        self.requests = 0
+        self.batches = 0
+
+    def _ensure_started(self):
+        if self._worker is None or self._worker.done():
+            self._executor = self._executor or ThreadPoolExecutor(max_workers=1)
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def predict(self, text: str) -> Tuple[int, float]:
+        """Queue one text and wait for its ``(label, confidence)``."""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, asyncio.get_running_loop().time()))
+        return await future
+
+    async def _next_batch(self) -> List:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        # Measured from when the oldest request was queued, not dequeued, so
+        # requests that arrived during the previous batch don't wait twice
+        deadline = batch[0][2] + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            batch = [item for item in batch if not item[1].cancelled()]
+            if not batch:
+                continue
+
+            texts = [text for text, _, _ in batch]
+            registry = get_metrics_registry()
+            if registry is not None:
+                now = loop.time()
+                registry.observe('microbatch_size', len(batch),
+                                 buckets=MetricsRegistry.BATCH_SIZE_BUCKETS)
+                for _, _, queued_at in batch:
+                    registry.observe('microbatch_queue_wait_seconds', now - queued_at)
+
+            try:
+                predictions, confidences = await loop.run_in_executor(
+                    self._executor,
+                    lambda: batch_predict(texts, self.model, self.tokenizer,
+                                          batch_size=len(texts), **self.batch_kwargs)[:2]
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.requests += len(batch)
+            self.batches += 1
+            for (_, future, _), label, confidence in zip(batch, predictions, confidences):
+                if not future.done():
+                    future.set_result((int(label), float(confidence)))
+
+    async def stop(self):
+        """Cancel the worker task and shut down the executor thread."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> Dict:
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+            'queued': self._queue.qsize() if self._queue is not None else 0,
+        }
+
+
+def create_app(model, tokenizer, label_names: List[str] = None, max_batch_size: int = 32,
+               max_wait_ms: float = 5.0, max_text_length: int = 10000, **batch_kwargs):
+    """Build a FastAPI app serving ``/predict`` through a ``MicroBatcher``.
+
+    Label names default to ``model.config.id2label``. Besides ``/predict``
+    the app exposes ``/health`` and ``/metrics`` (batcher counters as JSON,
+    or Prometheus text when instrumentation is enabled).
+    """
+    from fastapi import FastAPI, HTTPException
+    from fastapi.responses import PlainTextResponse
+    from pydantic import BaseModel
+
+    if label_names is None:
+        id2label = getattr(getattr(model, 'config', None), 'id2label', None) or {}
+        label_names = [id2label[i] for i in sorted(id2label)] or None
+
+    batcher = MicroBatcher(model, tokenizer, max_batch_size=max_batch_size,
+                           max_wait_ms=max_wait_ms, **batch_kwargs)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await batcher.stop()
+
+    app = FastAPI(title="Micro-batching Inference API", lifespan=lifespan)
+    app.state.batcher = batcher
+
+    class PredictionRequest(BaseModel):
+        text: str
+
+    class PredictionResponse(BaseModel):
+        label: str
+        label_id: int
+        confidence: float
+        processing_time_ms: float
+
+    @app.get("/health")
+    async def health_check():
+        return {"status": "healthy", "model_loaded": model is not None}
+
+    @app.post("/predict", response_model=PredictionResponse)
+    async def predict(request: PredictionRequest):
+        if not request.text.strip():
+            raise HTTPException(status_code=400, detail="Text cannot be empty")
+        if len(request.text) > max_text_length:
+            raise HTTPException(status_code=400, detail="Text is too long")
+
+        start_time = time.perf_counter()
+        label_id, confidence = await batcher.predict(request.text)
+        label = label_names[label_id] if label_names else str(label_id)
+        return PredictionResponse(
+            label=label,
+            label_id=label_id,
+            confidence=confidence,
+            processing_time_ms=(time.perf_counter() - start_time) * 1000,
+        )
+
+    @app.get("/metrics")
+    async def metrics():
+        registry = get_metrics_registry()
+        if registry is not None:
+            return PlainTextResponse(registry.to_prometheus())
+        return batcher.stats()
+
+    return app